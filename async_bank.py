@@ -0,0 +1,258 @@
+import asyncio
+import os
+import random
+import sys
+from datetime import datetime
+from time import time
+
+from bank import Bank
+from codec import pack_message, read_message
+from commons import KBHit, load_config
+from metrics import metrics
+import transport
+
+
+class AsyncBank(Bank):
+    """
+    A branch that runs on a single asyncio event loop.
+    Setup (id, listening socket and the inspector connection) is the same as Bank,
+    but peer channels and the inspector link run as coroutines instead of a few threads
+    per peer. Messages are handled by the same methods as Bank (see Bank._handle_message).
+    """
+
+    def __init__(self, *args, **kwargs):
+
+        # the event loop can only wait for sockets
+        config = load_config()
+        for conf in config['branches'] + [config['inspector']]:
+            if conf['transport'] == "shm":
+                raise ValueError("The shm transport cannot be used by the asyncio engine.")
+
+        super().__init__(*args, **kwargs)
+
+    def run(self):
+
+        asyncio.run(self._run())
+
+    async def _run(self):
+
+        await self._connect_to_branches()
+
+        self.inspector["conn"].setblocking(False)
+        _, self.inspector["conn"] = await asyncio.open_connection(sock=self.inspector["conn"])
+
+        self.loop = asyncio.get_running_loop()
+
+        for branch in self.branches:
+            metrics.gauge("bank_send_buffer_bytes", "Bytes waiting to be written.", {"to": branch["id"]},
+                          function=branch["out_conn"].transport.get_write_buffer_size)
+        metrics.gauge("bank_send_buffer_bytes", "Bytes waiting to be written.", {"to": "inspector"},
+                      function=self.inspector["conn"].transport.get_write_buffer_size)
+        self._serve_metrics(1 + self.id)
+
+        tasks = [self._do_common_transfer(branch["id"]) for branch in self.branches]
+        tasks += [self._do_common_receive(branch["id"]) for branch in self.branches]
+        tasks.append(self._report_periodically())
+
+        if self.snpsht_confs['keyboard']:
+            self._listen_to_keyboard()
+
+        if self.snpsht_confs['interval']:
+            tasks.append(self._schedule_snapshots())
+
+        if self.snpsht_confs['control_port'] is not None:
+            self.control_server = await asyncio.start_server(self._serve_control, 'localhost',
+                                       self.snpsht_confs['control_port'] + self.id)
+
+        await asyncio.gather(*tasks)
+
+    async def _report_periodically(self):
+        """
+        Reports the buffered events every `reports.interval` seconds.
+        See Bank._report_periodically.
+        :return: None
+        """
+        while True:
+            await asyncio.sleep(self.bank_confs['reports']['interval'])
+            self._flush_reports()
+
+    def take_snapshot(self):
+        """
+        Initiates a new snapshot. It can be called from any thread.
+        :return: id of the snapshot: (initiator, seq)
+        """
+        try:
+            in_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            in_loop = False
+
+        if in_loop:
+            return self._init_snapshot()
+
+        # the streams of the branch may only be written from the event loop
+        async def init_snapshot():
+            return self._init_snapshot()
+
+        return asyncio.run_coroutine_threadsafe(init_snapshot(), self.loop).result()
+
+    async def _schedule_snapshots(self):
+        """
+        Initiates the snapshots of this branch which are scheduled by `snapshot.interval`.
+        See Bank._next_snapshot_slot.
+        :return: None
+        """
+        while True:
+            delay, initiate = self._next_snapshot_slot()
+            await asyncio.sleep(delay)
+
+            if initiate:
+                self.take_snapshot()
+
+    async def _serve_control(self, reader, writer):
+        """
+        Handles a connection to the control port. See Bank._control_command.
+        """
+        async for line in reader:
+            writer.write(self._control_command(line.decode().strip()).encode() + b"\n")
+            await writer.drain()
+
+        writer.close()
+
+    async def _connect_to_branches(self):
+        """
+        Establishes the connections between this branch and all other branches.
+        See Bank._connect_to_branches.
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        hello = pack_message({"subject": "hello", "id": self.id})
+
+        async def accept():
+            # one at a time: the event loop has a single reader callback per socket
+            for _ in self.branches:
+                in_conn, _ = await loop.sock_accept(self.listener)
+                reader, writer = await asyncio.open_connection(sock=in_conn)
+
+                branch = self.branches[self._id_to_index((await read_message(reader))["id"])]
+                # the unused writer of the incoming stream is kept,
+                # otherwise it closes the connection when it is garbage collected.
+                branch["in_conn"], branch["in_writer"] = reader, writer
+
+        async def connect(branch):
+            _, branch["out_conn"] = await transport.open_connection(branch["endpoint"])
+            branch["out_conn"].write(hello)
+
+        self.listener.setblocking(False)
+        await asyncio.gather(accept(), *(connect(branch) for branch in self.branches))
+
+    def _send_message(self, conn, message):
+        """
+        Queues a message on the stream writer conn.
+        The event loop sends it in order with the other messages of the stream.
+        :param conn: asyncio.StreamWriter
+        :param message: it can be everything
+        :return: a dictionary with these keys: [status: Bool, send_time: datetime object]
+        """
+        send_time = datetime.now()
+
+        try:
+            conn.write(pack_message(message))
+            status = True
+        except:
+            status = False
+
+        return {
+            "status": status,
+            "send_time": send_time,
+        }
+
+    async def _do_common_transfer(self, receiver_id):
+        """
+        Transfers a random amount of money with a probability, to another branch,
+        every `time_step` seconds. See Bank._do_common_transfer.
+        :param receiver_id: id of the receiver.
+        :return: None
+        """
+        receiver = self.branches[self._id_to_index(receiver_id)]
+
+        max_n_send = self.max_n_send
+        while max_n_send > 0:
+            await asyncio.sleep(self.bank_confs['time_step'])
+
+            if self._random_transfer(receiver):
+                max_n_send -= 1
+
+            if receiver["batch"] and time() >= receiver["batch_deadline"]:
+                with self.lock:
+                    self._flush_batch(receiver)
+
+            try:
+                await receiver["out_conn"].drain()
+            except ConnectionError:
+                self._log(f"Lost the connection to the branch {receiver_id}.", in_file=True)
+                return
+
+        with self.lock:
+            self._flush_batch(receiver)
+
+        self._log(
+            f"Reached to the maximum number of sends "
+            f"({self.max_n_send} messages per branch)",
+            in_file=True)
+
+    async def _do_common_receive(self, sender_id):
+        """
+        Receives the messages of a branch with a specific id and schedules them on the
+        event loop, to be handled after a random delay which simulates the latency of the
+        connection. A delayed message does not hold the reception of the next ones, and
+        the messages of a branch are still handled in the order they were sent.
+        :param sender_id: id of the sender.
+        :return: None
+        """
+        loop = asyncio.get_running_loop()
+        sender_index = self._id_to_index(sender_id)
+        sender = self.branches[sender_index]
+
+        min_delay = self.brnch_confs[self.id]['delay']['min']
+        max_delay = self.brnch_confs[self.id]['delay']['max']
+        time_step = self.bank_confs['time_step']
+        # delivery time of the previous message
+        last = 0
+
+        while True:
+            message = await read_message(sender["in_conn"])
+            if message is None:
+                return
+
+            # The timers of the loop are not ordered when they are due at the same time,
+            # so the delivery times of a channel are strictly increasing.
+            last = max(loop.time() + time_step * random.randint(min_delay, max_delay), last + 1e-6)
+            loop.call_at(last, self._handle_message, sender_index, message)
+
+    def _listen_to_keyboard(self):
+        """
+        Initiates a snapshot whenever 's' is entered in the terminal.
+        """
+        if not sys.stdin.isatty():
+            self._log("No terminal is attached. Snapshots cannot be initiated from keyboard.")
+            return
+
+        kb = KBHit()
+        self._log(
+            "TO GET A SNAPSHOT -> Enter 's' \n"
+        )
+
+        def on_key():
+            if "s" in kb.getch().lower():
+                self._init_snapshot()
+
+        if os.name == 'nt':
+            async def poll_keyboard():
+                while True:
+                    if kb.kbhit():
+                        on_key()
+                    await asyncio.sleep(0.1)
+
+            self.keyboard_task = asyncio.ensure_future(poll_keyboard())
+        else:
+            asyncio.get_running_loop().add_reader(sys.stdin.fileno(), on_key)
@@ -1,21 +1,42 @@
-import pickle
 import socket
 import random
-import json
+import sys
+from array import array
 from datetime import datetime
-from time import sleep
-from queue import Queue
-from threading import Thread, Lock
+from time import sleep, time, time_ns
+from threading import Thread, Event
 
 from commons import Constants, KBHit, BaseClass
+from codec import FrameReader, pack_message
+from events import EventBuffer
+from outbox import Outbox
+from delivery import DelayedDelivery
+from metrics import metrics
+from profiling import profiler
+from registry import Registry
+import transport
+
+
+def send_command(bid: int, command: str, control_port: int, address: str = 'localhost') -> str:
+    """
+    Sends a command to the control port of a branch.
+    :param bid: id of the branch.
+    :param command: e.g. "snapshot"
+    :param control_port: `control_port` of the snapshot section of the config.
+    :param address: address of the branch.
+    :return: the reply of the branch.
+    """
+    with socket.create_connection((address, control_port + bid)) as conn:
+        conn.sendall(command.encode() + b"\n")
+        return conn.makefile().readline().strip()
 
 
 class Bank(BaseClass):
 
     # Class Variables
     consts = Constants()
-    consts.dir_bank.mkdir() if not consts.dir_bank.is_dir() else None
-    bank_file = consts.dir_bank / "bank.json"
+    # ids and addresses of the branches. See registry.Registry.
+    registry = Registry(consts.dir_bank)
     branches_public_details = []
     next_id = 0
 
@@ -23,30 +44,19 @@ class Bank(BaseClass):
     @classmethod
     def load_class_vars(cls, ):
 
-
-        while True:
-            try:
-                if not Bank.bank_file.is_file():
-                    Bank.next_id = 0
-                    Bank.branches_public_details = []
-                    return
-
-                with open(Bank.bank_file, "r") as f:
-                    temp = f.read()
-                bank_vars = json.loads(temp)
-
-                Bank.next_id = len(bank_vars["branch_details"])
-                Bank.branches_public_details = bank_vars["branch_details"]
-                return
-            except:
-                continue
+        Bank.branches_public_details = Bank.registry.members()
+        Bank.next_id = len(Bank.branches_public_details)
 
     @classmethod
-    def save_class_vars(cls, ):
-
-        with open(Bank.bank_file, "w") as f:
-            json.dump({"branch_details":Bank.branches_public_details}, f)
-
+    def wait_for_branches(cls, n_branches: int):
+        """
+        Blocks until `n_branches` branches are registered.
+        It is woken up by the registrations instead of polling the registry.
+        :param n_branches: number of branches to wait for.
+        :return: None
+        """
+        Bank.branches_public_details = Bank.registry.wait(n_branches)
+        Bank.next_id = len(Bank.branches_public_details)
 
     def __init__(
         self,
@@ -62,13 +72,27 @@ class Bank(BaseClass):
 
         self.n_branches = len(self.brnch_confs)
 
-        Bank.load_class_vars()
-
-        self.lock = Lock()
+        # guards the balance and the snapshots in progress
+        self.lock = metrics.timed_lock("bank_lock_wait_seconds",
+                                       "Time waited to acquire the lock of the branch.")
+        # set when the threads of the branch should stop
+        self.stopped = Event()
         self.branches = []
-        self.recv_queue = [Queue() for _ in range(self.n_branches)]
-        self.id = Bank.next_id
-        Bank.next_id += 1
+        # holds the received messages for their simulated latency
+        self.delivery = DelayedDelivery(self._handle_message)
+
+        def public_details(bid):
+            # Every branch has a single listener, which accepts the connections
+            # of all other branches. Its endpoint is published in the registry.
+            endpoint = transport.make_endpoint(
+                self.brnch_confs[bid], Bank.consts.dir_bank / f"branch_{bid}.sock", address)
+            self.listener, endpoint = transport.listen(endpoint, backlog=self.n_branches)
+
+            return endpoint
+
+        # the id is assigned atomically, even if several branches start at the same time
+        details = Bank.registry.register(public_details)
+        self.id = details["id"]
 
         self.balance = self.bank_confs['initial_balance']
         if self.balance is None:
@@ -78,75 +102,97 @@ class Bank(BaseClass):
         if self.max_n_send is None:
             self.max_n_send = max_number_of_send
 
-        Bank.consts.dir_logs.mkdir() if not Bank.consts.dir_logs.is_dir() else None
+        # send and receive events waiting to be reported to the inspector. See _report.
+        self.sent_events = EventBuffer(
+            "sends", {"sender_id": self.id},
+            ("receiver_ids", "amounts", "seqs", "send_times"), self.bank_confs['reports']['size'])
+        self.received_events = EventBuffer(
+            "receives", {"receiver_id": self.id},
+            ("sender_ids", "amounts", "seqs", "receive_times"), self.bank_confs['reports']['size'])
+
+        # several branches may create it at the same time
+        Bank.consts.dir_logs.mkdir(exist_ok=True)
         self.log_database = Bank.consts.dir_logs / f"branch_{self.id}.log"
 
         self._log(f"Branch {self.id} started working.", in_file=True, file_mode='w')
 
-        self.do_snapshot = -1
-        self.local_snapshots = []
-        self.got_marker = False
-
-        self.address = self.brnch_confs[self.id]['address']
-        if self.address is None:
-            self.address = address
+        # snapshots in progress, indexed by their ids: (initiator, seq)
+        self.snapshots = {}
+        # seq of the next snapshot initiated by this branch
+        self.snapshot_seq = 0
 
-        Bank.branches_public_details.append({"id": self.id, "address": self.address})
-        Bank.save_class_vars()
+        self.address = details["address"]
 
         self._init_other_branches()
 
         self.inspector = {
-            "port": self.inspctr_confs['port_base_out'] + self.id,
-            "address": self.inspctr_confs['address'],
+            "endpoint": transport.make_endpoint(self.inspctr_confs, Bank.consts.dir_bank / "inspector.sock"),
             "conn": None}
 
         self._init_inspector()
 
+        self._init_metrics()
+
         self._log(f"BRANCH {self.id} LOG\n", in_file=True, stdio=False, file_mode="w")
 
+    def _init_metrics(self):
+        """
+        Creates the metrics of the branch. See metrics.py.
+        :return: None
+        """
+        self.transfers_sent = metrics.counter(
+            "bank_transfers_sent_total", "Transfers sent to the other branches.")
+        self.transfers_received = metrics.counter(
+            "bank_transfers_received_total", "Transfers received from the other branches.")
+        self.snapshot_duration = metrics.histogram(
+            "bank_snapshot_seconds",
+            "Time from the initiation of a snapshot by this branch to its global snapshot.")
+        self.local_snapshot_duration = metrics.histogram(
+            "bank_local_snapshot_seconds",
+            "Time from recording the state of this branch to the last marker of a snapshot.")
+
+        metrics.gauge("bank_balance", "Balance of the branch.", function=lambda: self.balance)
+        metrics.gauge("bank_snapshots_in_progress", "Snapshots which are recording channels.",
+                      function=lambda: len(self.snapshots))
+
     def _init_other_branches(self):
         """
         Initiates information of other branches.
         Not all parts are completed.
         In this function the following information will be initiated:
             id: the of every branch
-            port: the port that the other branch is listening through it.
-            in_sock: the socket which this branch will listen to the branch with a specific id.
-            out_conn: the socket that this branch can connect to the other branch with a specific id.
+            endpoint: the listener of the other branch. See transport.
             address: the ip address of the other branch with a specific id.
-        The following information cannot be initiated by this function:
+        The following information cannot be initiated by this function (see _connect_to_branches):
             in_conn: the connection that the branch with a specific id will use to send a message to this branch.
-            last_message: the last message which this branch received from the branch with a specific id.
+            in_reader: FrameReader of in_conn.
+            out_conn: the connection that this branch uses to send a message to the other branch.
         :return: None
         """
         self._log("Waiting for other branches ...")
 
-        while True:
-            Bank.load_class_vars()
-
-            if len(Bank.branches_public_details) == self.n_branches:
-                self._log(
-                    f"All {self.n_branches} branches are open now. "
-                     "Resuming the process ...")
-                break
+        Bank.wait_for_branches(self.n_branches)
+        self._log(
+            f"All {self.n_branches} branches are open now. "
+             "Resuming the process ...")
 
         for i in range(self.n_branches):
             if i != self.id:
-                port =  self.brnch_confs[i]['port_base_in'] + self.id + i * 10
-                port_out = self.brnch_confs[self.id]['port_base_out'] \
-                         + self.id  * 10 + i
                 self.branches.append({
                     "id": Bank.branches_public_details[i]["id"],
-                    "port": port_out,
                     "address": Bank.branches_public_details[i]["address"],
-                    "in_sock": socket.socket(socket.AF_INET, socket.SOCK_STREAM),
+                    # how to connect to the branch. See transport.
+                    "endpoint": Bank.branches_public_details[i],
                     "in_conn": None,
-                    "out_conn": socket.socket(socket.AF_INET, socket.SOCK_STREAM),
-                    "last_message": Queue()
+                    "in_reader": None,
+                    "out_conn": None,
+                    # sequence number of the next transfer to this branch
+                    "send_seq": 0,
+                    # amounts of the transfers which are not sent yet. See _batch_transfer.
+                    "batch": [],
+                    "batch_seq": 0,
+                    "batch_deadline": 0
                 })
-                self.branches[-1]["in_sock"].bind((self.address, port))
-                self.branches[-1]["in_sock"].listen(1)
 
     def _init_inspector(self):
         """
@@ -157,12 +203,13 @@ class Bank(BaseClass):
 
         while True:
             try:
-                insp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                insp_sock.connect((self.inspector["address"], self.inspector["port"]))
-                self.inspector["conn"] = insp_sock
+                insp_conn = transport.connect(self.inspector["endpoint"])
+                insp_conn.sendall(pack_message({"subject": "hello", "id": self.id}))
+                self.inspector["conn"] = insp_conn
                 break
-            except ConnectionRefusedError:
-                insp_sock.close()
+            except (ConnectionRefusedError, FileNotFoundError):
+                # the inspector is not listening yet
+                sleep(0.1)
 
         self._log("Connected to Inspector.")
 
@@ -175,65 +222,96 @@ class Bank(BaseClass):
         :return: results. It is a dictionary containing the keys below:
             status: Boolean. Whether the transfer was successful or not.
             send_time: datetime object. The sending time.
+            seq: sequence number of the transfer on the channel to the receiver.
         """
-        # TODO: Write something like the below:
-        if amount > self.balance:
-            message = (f"Transfer Failed: "
-                        f"The amount of money needed to transfer "
-                        "is more than assets of the branch #{self.id}.")
+        # The balance is debited and the message is queued atomically with respect to
+        # _do_snappy_things, so a transfer is either part of the recorded balance or
+        # queued after the marker.
+        with self.lock:
+            # TODO: Write something like the below:
+            if amount > self.balance:
+                message = (f"Transfer Failed: "
+                            f"The amount of money needed to transfer "
+                            "is more than assets of the branch #{self.id}.")
+
+                if show_error:
+                    self._log(message, in_file=True)
+
+                # raise message
+                return {"status": False}
+
+            seq = receiver["send_seq"]
+            if self.bank_confs['batch']['size'] > 1:
+                result = self._batch_transfer(receiver, amount)
+            else:
+                message = {"subject":"transfer", "amount": amount, "seq": seq}
+                result = self._send_message(receiver["out_conn"], message)
+            result["seq"] = seq
 
-            if show_error:
-                self._log(message, in_file=True)
+            # check whether status == True or not
+            if result["status"]:
+                self.balance -= amount
+                receiver["send_seq"] += 1
+                self.transfers_sent.inc()
 
-            # raise message
-            return {"status": False}
+        self._log(
+            'Branch {}: {}{}{:<6}Transferred TO the branch {:>2}. (send_time:{:%Y-%m-%d:%H:%M:%S})',
+            self.id, self.sign_before, amount, self.merged_unit_sign_after,
+            receiver["id"], result["send_time"],
+            in_file=True, level="debug")
 
-        message = {"subject":"transfer", "amount": amount}
-        result = self._send_message(receiver["out_conn"], message)
+        return result
 
-        # check whether status == True or not
-        if result["status"]:
-            self.balance -= amount
+    def _batch_transfer(self, receiver, amount: int):
+        """
+        Adds a transfer to the batch of the receiver. The batch is sent when it is full,
+        when its delay has passed (see _do_common_transfer) or before a marker.
+        Must be called with self.lock held.
+        :param receiver: the receiver dictionary (an item of self.branches).
+        :param amount: amount in integer.
+        :return: a dictionary with these keys: [status: Bool, send_time: datetime object]
+        """
+        if not receiver["batch"]:
+            receiver["batch_seq"] = receiver["send_seq"]
+            receiver["batch_deadline"] = time() + self.bank_confs['batch']['delay']
 
-        time_format = "%Y-%m-%d:%H:%M:%S"
-        c_sign = self.bank_confs['currency']['symbol']
-        c_unit = self.bank_confs['currency']['unit']
-        s_place = self.bank_confs['currency']['placement']
-        sign_before = f'{c_sign if s_place == "before" else ""}'
-        sign_after = f'{c_sign if s_place == "after" else ""}'
-        merged_unit_sign_after = c_unit + ' ' + sign_after
-        self._log(
-            f'Branch {self.id}: '
-            f'{sign_before}'
-            f'{amount}'
-            # f'{c_unit:<4} '
-            # f'{sign_after} '
-            f'{merged_unit_sign_after:<6}'
-            f'Transferred TO the branch '
-            f'{receiver["id"]:>2}. '
-            f'(send_time:{result["send_time"].strftime(time_format)})',
-            in_file=True)
+        receiver["batch"].append(amount)
 
-        return result
+        if len(receiver["batch"]) >= self.bank_confs['batch']['size']:
+            self._flush_batch(receiver)
+
+        # a broken connection is noticed by the receiving side when the batch is sent
+        return {
+            "status": True,
+            "send_time": datetime.now(),
+        }
+
+    def _flush_batch(self, receiver):
+        """
+        Sends the batched transfers to the receiver, as one message.
+        Must be called with self.lock held, so that the batch is never split by a marker.
+        :param receiver: the receiver dictionary (an item of self.branches).
+        :return: None
+        """
+        if not receiver["batch"]:
+            return
+
+        message = {"subject": "transfers", "seq": receiver["batch_seq"], "amounts": receiver["batch"]}
+        self._send_message(receiver["out_conn"], message)
+        receiver["batch"] = []
 
     def _send_message(self, conn, message):
         """
         Sends a message through the connection conn.
-        :param conn: socket connection
+        The message is queued on the outbox of the connection, so slow connections
+        do not delay the others. Messages of a connection are sent in order.
+        It never blocks, so it can be called with self.lock held. See _wait_for_room.
+        :param conn: Outbox of the connection
         :param message: it can be everything
         :return: a dictionary with these keys: [status: Bool, send_time: datetime object]
         """
-        self.lock.acquire()
         send_time = datetime.now()
-
-        try:
-            message = pickle.dumps(message)
-            conn.sendall(message)
-            status = True
-        except:
-            status = False
-
-        self.lock.release()
+        status = conn.send(message)
 
         return {
             "status": status, # True (succeeded) or False (failed)
@@ -248,9 +326,13 @@ class Bank(BaseClass):
         It calls two other methods per each thread:
             _do_common_transfer: transfer procedure
             _do_common_receive: receive messages. It will be called for each branch.
+        The received messages are handled by one more thread when their delay is over.
+        See DelayedDelivery.
         :return: None
         """
 
+        Thread(target=self.delivery.run, args=(self.stopped, ), name="delivery_th").start()
+
         receive = []
         send = []
         for branch in self.branches:
@@ -267,22 +349,20 @@ class Bank(BaseClass):
     def _do_common_transfer(self, receiver_id):
         """
         Transfers a random amount of money with a probability, to another branch.
-        After every transfer, a message will be sent to inspector.
-        The Message Structure is like the example below:
-            {"subject": "send",
-             "sender_id": 2,
-             "receiver_id": 1,
-             "send_time": datetime.now(),
-             "amount": 500}
+        Every transfer is reported to the inspector as a send event:
+            (receiver id, amount, seq, send time in ns)
+        The events are sent in batches, as columns. See _report.
+            seq numbers the transfers of each channel, so that the inspector can match
+            the send and receive events of a transfer.
         :param
             receiver_id: Id of the receiver information.
                 The receiver itself is a dictionary that its keys
                  are the same as the self.branch:
                  [id:integer,
-                 "port": integer,
                  "address": string,
-                 "in_sock": socket,
+                 "endpoint": dictionary (see transport),
                  "in_conn": input socket connection,
+                 "in_reader": FrameReader of in_conn,
                  "out_conn": output socket connection]
         :return: None
         """
@@ -290,56 +370,87 @@ class Bank(BaseClass):
         receiver = self.branches[receiver_id]
 
         max_n_send = self.max_n_send
-        p_trnsction = self.bank_confs['transaction']['p']
-        min_amount = self.bank_confs['transaction']['min']
-        max_amount = self.bank_confs['transaction']['max']
         while True:
             if max_n_send == 0:
                 self._log(
                     f"Reached to the maximum number of sends "
                     f"({self.max_n_send} messages per branch)",
                     in_file=True)
+                break
+
+            if self.stopped.wait(self.bank_confs['time_step']):
+                break
+
+            if self._random_transfer(receiver):
+                max_n_send -= 1
 
+            if receiver["batch"] and time() >= receiver["batch_deadline"]:
+                with self.lock:
+                    self._flush_batch(receiver)
+
+            # outside of the lock, so a slow connection only holds up the transfers to it
+            self._wait_for_room(receiver["out_conn"])
+            self._wait_for_room(self.inspector["conn"])
+
+        with self.lock:
+            self._flush_batch(receiver)
+
+    def _wait_for_room(self, conn):
+        """
+        Waits until the outbox conn has room for more messages (see Outbox.drain),
+        or the branch stops. Must not be called with self.lock held.
+        :param conn: Outbox of the connection
+        :return: None
+        """
+        while not self.stopped.is_set():
+            if conn.drain(Constants.wait_timeout):
                 return
 
-            sleep(self.bank_confs['time_step'])
+    def _random_transfer(self, receiver):
+        """
+        Transfers a random amount of money to the receiver with probability `p`
+        and reports the transfer to the inspector.
+        :param receiver: the receiver dictionary (an item of self.branches).
+        :return: True if money was transferred, False otherwise.
+        """
+        if random.random() > self.bank_confs['transaction']['p']:
+            return False
+
+        return self._transfer_random_amount(receiver)
 
-            if random.random() <= p_trnsction:
-                amount = random.randint(min_amount, max_amount)
-                result = self.transfer(amount, receiver, show_error=True)
+    def _transfer_random_amount(self, receiver):
+        """
+        Transfers a random amount of money to the receiver and reports the transfer to the inspector.
+        :param receiver: the receiver dictionary (an item of self.branches).
+        :return: True if money was transferred, False otherwise.
+        """
+        amount = random.randint(self.bank_confs['transaction']['min'],
+                                self.bank_confs['transaction']['max'])
+        result = self.transfer(amount, receiver, show_error=True)
 
-                if result["status"]:
-                    message = {
-                        "subject": "send",
-                        "sender_id": self.id,
-                        "receiver_id": receiver["id"],
-                        "send_time": result["send_time"],
-                        "amount": amount,
-                    }
+        if not result["status"]:
+            return False
 
-                    self._send_message(conn=self.inspector["conn"], message=message)
+        self._report(self.sent_events.add(receiver["id"], amount, result["seq"], time_ns()))
 
-                    max_n_send -= 1
+        return True
 
     def _do_common_receive(self, sender_id):
         """
-        Receives an amount of money from a branch with a specific id (in_soc_id).
-        It also checks whether a snapshot request has been sent or not.
-        If true, it will toggle on snapshot flag.
+        Receives the messages of a branch with a specific id (in_soc_id) and schedules them
+        to be handled after a random delay, which simulates the latency of the connection.
+        The messages of a branch are handled in the order they were sent, and a delayed
+        message does not hold the reception of the next ones. See DelayedDelivery.
         :param sender_id: The id of sender information.
         The sender itself is a dictionary which its keys are same as the self.branch:
             [id:integer,
-            "port": integer,
             "address": string,
-            "in_sock": socket,
+            "endpoint": dictionary (see transport),
             "in_conn": input socket connection,
+            "in_reader": FrameReader of in_conn,
             "out_conn": output socket connection]
         :return:
         """
-
-        recv_messages_th = Thread(target=self._recv_messages, args=(sender_id,), name="recv_messages_th")
-        recv_messages_th.start()
-
         sender_index = self._id_to_index(sender_id)
         sender = self.branches[sender_index]
 
@@ -347,246 +458,439 @@ class Bank(BaseClass):
         max_delay = self.brnch_confs[self.id]['delay']['max']
         time_step = self.bank_confs['time_step']
 
-        while True:
-            if not self.recv_queue[sender_index].empty():
-                message = self.recv_queue[sender_index].get()
-                # Add an intentional delay to simulate connection latency.
-                sleep(time_step * random.randint(min_delay, max_delay))
-            else:
-                continue
+        try:
+            for message in sender["in_reader"]:
+                self.delivery.put(sender_index, message, time_step * random.randint(min_delay, max_delay))
+        except OSError:
+            # the connection was closed by stop()
+            return
 
-            recv_time = datetime.now()
-            amount = 0
-            if message["subject"].lower() == "transfer":
-                amount += message["amount"]
-                self.balance += amount
+    def _handle_message(self, sender_index, message):
+        """
+        Applies a message which has arrived from the branch self.branches[sender_index].
+        The messages of a channel must be handled in the order they were sent.
+        :param sender_index: index of the sender in self.branches.
+        :param message: transfer, marker or (local) snapshot message.
+        :return: None
+        """
+        subject = message["subject"].lower()
 
-                message_to_insp = {
-                    "subject": "receive",
-                    "amount": message["amount"],
-                    "sender_id": sender["id"],
-                    "receiver_id": self.id,
-                    "receive_time": recv_time
-                }
+        if subject == "transfer":
+            self._receive_transfer(sender_index, message)
 
-                self._send_message(conn=self.inspector["conn"], message=message_to_insp)
+        elif subject == "transfers":
+            self._receive_transfers(sender_index, message)
 
-            elif message["subject"].lower() == "snapshot":
-                self._log(f"Branch {sender_id} has just sent its local snapshot.", in_file=True)
-                self.local_snapshots.append(message)
+        elif subject == "marker":
+            self._check_for_marker(sender_index, message)
 
-            last_message = {"recv_time": recv_time, "amount": amount, "subject": message["subject"]}
-            if "initiator" in message.keys():
-                last_message["initiator"] = message["initiator"]
+        elif subject == "snapshot":
+            self._log(f"Branch {message['id']} has just sent its local snapshot. "
+                      f"(Snapshot {message['initiator']}.{message['seq']})", in_file=True)
+            self._collect_local_snapshot(message)
 
-            self.branches[sender_index]["last_message"].put(last_message)
+    def _receive_transfer(self, sender_index, message):
 
-    def _recv_messages(self, sender_id):
+        recv_time = time_ns()
 
-        sender_index = self._id_to_index(sender_id)
-        sender = self.branches[sender_index]
-        while True:
-            pickled_data = sender["in_conn"].recv(4096)
-            message = pickle.loads(pickled_data)
-            self.recv_queue[sender_index].put(message)
+        with self.lock:
+            self.balance += message["amount"]
+            self._inspect_channel(sender_index, message["amount"])
 
+        self.transfers_received.inc()
 
-    def snapshot_process(self):
+        self._report(self.received_events.add(
+            self.branches[sender_index]["id"], message["amount"], message["seq"], recv_time))
 
-        while True:
-            init_snapshot_th = Thread(target=self._init_snapshot, name="init_snapshot_th")
-            check_for_marker_th = Thread(target=self._check_for_marker, name="check_for_marker_th")
-            init_snapshot_th.start()
-            check_for_marker_th.start()
+    def _receive_transfers(self, sender_index, message):
+        """
+        Applies a batch of transfers at once, so that a snapshot records either all of them
+        or none of them. See _batch_transfer.
+        :param sender_index: index of the sender in self.branches.
+        :param message: {"subject": "transfers", "seq": seq of the first transfer, "amounts": list}
+        :return: None
+        """
+        recv_time = time_ns()
+        total = sum(message["amounts"])
 
-            check_for_marker_th.join()
-            init_snapshot_th.join()
+        with self.lock:
+            self.balance += total
+            self._inspect_channel(sender_index, total)
 
-            self.got_marker = False
-            self.do_snapshot = -1
-            self.local_snapshots = []
+        self.transfers_received.inc(len(message["amounts"]))
 
-    def _init_snapshot(self):
+        sender_id = self.branches[sender_index]["id"]
+        for i, amount in enumerate(message["amounts"]):
+            self._report(self.received_events.add(sender_id, amount, message["seq"] + i, recv_time))
+
+    def _report(self, events):
+        """
+        Sends a batch of send or receive events to the inspector.
+        :param events: message of an EventBuffer, or None.
+        :return: None
+        """
+        if events is not None:
+            self._send_message(conn=self.inspector["conn"], message=events)
+
+    def _flush_reports(self):
+        """
+        Reports the buffered events to the inspector.
+        :return: None
+        """
+        self._report(self.sent_events.take())
+        self._report(self.received_events.take())
+
+    def _report_periodically(self):
+        """
+        Reports the buffered events every `reports.interval` seconds, so they are not kept
+        waiting for a full batch.
+        :return: None
+        """
+        while not self.stopped.wait(self.bank_confs['reports']['interval']):
+            self._flush_reports()
+
+        self._flush_reports()
+
+    def snapshot_process(self):
+        """
+        Initiates a snapshot whenever 's' is entered in the terminal.
+        The snapshots themselves are driven by the received messages (see _handle_message),
+        so several of them can be in progress at the same time.
+        :return: None
+        """
+        if not sys.stdin.isatty():
+            self._log("No terminal is attached. Snapshots cannot be initiated from keyboard.")
+            return
 
         kb = KBHit()
         self._log(
         "TO GET A SNAPSHOT -> Enter 's' \n"
         )
-        while True:
-            if kb.kbhit():
-                character = kb.getch().lower()
 
-                if "s" in character:
-                    self._log("Initiating a snapshot.", in_file=True)
-                    kb.set_normal_term()
-                    # do snapshot
-                    break
+        while not self.stopped.is_set():
+            if kb.kbhit(timeout=Constants.wait_timeout) and "s" in kb.getch().lower():
+                self._init_snapshot()
 
-                # TODO: implement global quit
-                elif "q" in character:
-                    self._log("Initiating a snapshot.", in_file=True)
-                    kb.set_normal_term()
+        kb.set_normal_term()
 
+    def take_snapshot(self):
+        """
+        Initiates a new snapshot. It can be called from any thread.
+        :return: id of the snapshot: (initiator, seq)
+        """
+        return self._init_snapshot()
 
-            if self.got_marker:
-                kb.set_normal_term()
+    def _schedule_snapshots(self):
+        """
+        Initiates the snapshots of this branch which are scheduled by `snapshot.interval`.
+        :return: None
+        """
+        while True:
+            delay, initiate = self._next_snapshot_slot()
+
+            if self.stopped.wait(delay):
                 return
 
-        self.got_marker = True
-        local, channels = self._do_snappy_things(initiator=self.id)
-        request_time = datetime.now()
+            if initiate:
+                self.take_snapshot()
 
-        try:
-            on_the_fly = sum(channels)
-            # Uncomment it if you want to get per channel amounts
-            # on_the_fly = channels
-        except TypeError:
-            on_the_fly = 0
+    def _next_snapshot_slot(self):
+        """
+        Scheduled snapshots happen at the multiples of `interval` seconds on the clock.
+        So the branches agree on the initiator of each slot without talking to each other.
+        :return: (seconds until the next slot, whether this branch initiates it)
+        """
+        interval = self.snpsht_confs['interval']
 
-        local_snapshot = {
-            "id": self.id,
-            "subject": "snapshot",
-            "balance": local,
-            "on_the_fly": on_the_fly
-        }
+        now = time()
+        slot = int(now // interval) + 1
 
-        while True:
-            if len(self.local_snapshots) == self.n_branches - 1:
-                break
+        if self.snpsht_confs['rotate']:
+            initiator = Bank.branches_public_details[slot % self.n_branches]["id"]
+        else:
+            initiator = self.snpsht_confs['initiator']
 
-        self.local_snapshots.append(local_snapshot)
+        return slot * interval - now, initiator == self.id
 
-        preparation_time = datetime.now()
+    def _serve_control(self):
+        """
+        Accepts commands on the control port of this branch (see _control_command).
+        Every command is a line and gets a one-line reply.
+        :return: None
+        """
+        server = socket.create_server(('localhost', self.snpsht_confs['control_port'] + self.id))
+        server.settimeout(Constants.wait_timeout)
+
+        with server:
+            while not self.stopped.is_set():
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    continue
 
-        self._create_global_snapshot(request_time, preparation_time)
+                # an idle client must not keep the others waiting
+                Thread(target=self._serve_control_client, args=(conn, ),
+                       name="control_client_th", daemon=True).start()
 
-        kb.set_normal_term()
+    def _serve_control_client(self, conn):
+        """
+        Replies to the commands of a client of the control port, until it disconnects
+        or the branch stops.
+        :param conn: the socket of the client.
+        :return: None
+        """
+        conn.settimeout(Constants.wait_timeout)
+        pending = b""
+
+        with conn:
+            while not self.stopped.is_set():
+                try:
+                    data = conn.recv(4096)
+                except socket.timeout:
+                    continue
+                except OSError:
+                    return
 
-    def _create_global_snapshot(self, request_time, preparation_time):
+                if not data:
+                    return
 
-        message = {
-            "subject": "global_snapshot",
-            "local_snapshots": [{"id": local["id"],
-                                 "balance": local["balance"],
-                                 "in_channels": local["on_the_fly"]}
-                                for local in self.local_snapshots],
-            "request_time": request_time,
-            "preparation_time": preparation_time
-        }
+                *lines, pending = (pending + data).split(b"\n")
+                for line in lines:
+                    reply = self._control_command(line.decode().strip()) + "\n"
+                    try:
+                        conn.sendall(reply.encode())
+                    except OSError:
+                        return
 
-        self._send_message(conn=self.inspector["conn"], message=message)
+    def _control_command(self, command: str) -> str:
+        """
+        Runs a command which has been received on the control port.
+            snapshot: initiates a snapshot. The reply is its id, e.g. "2.5" (initiator.seq).
+            ping: the reply is "pong". The control port is served once the branch
+                is connected to the others and to the inspector, so it tells that it is ready.
+            profile: writes the profiles collected so far (see profiling.py).
+                The reply is their directory.
+        :param command: the command.
+        :return: the reply.
+        """
+        if command == "snapshot":
+            initiator, seq = self.take_snapshot()
+            return f"{initiator}.{seq}"
 
+        if command == "ping":
+            return "pong"
 
+        if command == "profile":
+            return profiler.dump()
 
-    def _check_for_marker(self):
+        return f"unknown command: {command}"
 
-        branch_idx = 0
-        while True:
+    def _init_snapshot(self):
+        """
+        Initiates a new snapshot.
+        :return: id of the snapshot: (initiator, seq)
+        """
+        with self.lock:
+            snapshot_id = (self.id, self.snapshot_seq)
+            self.snapshot_seq += 1
 
-            if self.got_marker:
-                return 0
+            self._log(f"Initiating snapshot {self.id}.{snapshot_id[1]}.", in_file=True)
+            self._do_snappy_things(snapshot_id)
 
-            if self.branches[branch_idx]["last_message"].empty():
-                branch_idx = (branch_idx + 1) % (self.n_branches - 1)
-                continue
+        return snapshot_id
 
-            last_message = self.branches[branch_idx]["last_message"].get()
-            if last_message["subject"] == "marker":
-                sender_index = branch_idx
-                break
+    def _do_snappy_things(self, snapshot_id, exclude_index=None):
+        """
+        Records the state of this branch and sends a marker on every outgoing channel.
+        Every incoming channel, except the one the first marker came from, is then recorded
+        until its marker arrives. Must be called with self.lock held.
+        :param snapshot_id: (initiator, seq)
+        :param exclude_index: index of the branch whose marker started the snapshot here.
+        :return: the state of the snapshot.
+        """
+        recording = set(range(len(self.branches))) - {exclude_index}
+
+        snapshot = {
+            "id": snapshot_id,
+            "balance": self.balance,
+            "recording": recording,
+            "channels": {index: 0 for index in recording},
+            "request_time": datetime.now(),
+            # only used by the initiator
+            "local_snapshots": []
+        }
+        self.snapshots[snapshot_id] = snapshot
 
-            branch_idx = (branch_idx + 1) % (self.n_branches - 1)
+        message = {"subject": "marker", "initiator": snapshot_id[0], "seq": snapshot_id[1]}
+        for branch in self.branches:
+            # the batched transfers were debited before the balance was recorded
+            self._flush_batch(branch)
+            status = self._send_message(branch["out_conn"], message)
+            if status["status"]:
+                self._log(f"Sent marker TO {branch['id']}", in_file=True)
 
-        self._log(f"Branch {self.branches[sender_index]['id']} has sent a snapshot request. "
-                  f"(Initiator: Branch {last_message['initiator']})", in_file=True)
+        return snapshot
 
-        local, channels = self._do_snappy_things(exclude_index=sender_index, initiator=last_message['initiator'])
+    def _inspect_channel(self, sender_index, amount):
+        """
+        Adds money which has arrived on a channel to the snapshots that are recording it.
+        Must be called with self.lock held.
+        :param sender_index: index of the sender in self.branches.
+        :param amount: the transferred amount.
+        :return: None
+        """
+        for snapshot in self.snapshots.values():
+            if sender_index in snapshot["recording"]:
+                snapshot["channels"][sender_index] += amount
 
-        try:
-            on_the_fly = sum(channels)
-            # Uncomment it if you want to get per channel amounts
-            # on_the_fly = channels
-        except TypeError:
-            on_the_fly = 0
+    def _check_for_marker(self, sender_index, message):
+        """
+        Starts a snapshot on its first marker, otherwise stops recording the channel
+        that the marker came from. When every marker of the snapshot has arrived,
+        the local snapshot goes to the initiator.
+        :param sender_index: index of the sender in self.branches.
+        :param message: the marker.
+        :return: None
+        """
+        snapshot_id = (message["initiator"], message["seq"])
 
-        local_snapshot = {
-            "id": self.id,
-            "subject": "snapshot",
-            "balance": local,
-            "on_the_fly": on_the_fly
-        }
-        intitator_idx = self._id_to_index(last_message["initiator"])
-        self._send_message(conn=self.branches[intitator_idx]["out_conn"], message=local_snapshot)
+        with self.lock:
+            snapshot = self.snapshots.get(snapshot_id)
 
-        self.got_marker = True
-        return 1
+            if snapshot is None:
+                self._log(f"Branch {self.branches[sender_index]['id']} has sent a snapshot request. "
+                          f"(Snapshot {snapshot_id[0]}.{snapshot_id[1]})", in_file=True)
 
-    def _do_snappy_things(self, initiator, exclude_index=None ):
+                snapshot = self._do_snappy_things(snapshot_id, exclude_index=sender_index)
+            else:
+                snapshot["recording"].discard(sender_index)
 
-        own_state = self.balance
-        message = {"subject": "marker", "initiator": initiator }
+            if snapshot["recording"]:
+                return
 
-        que = Queue()
-        threads = []
-        for branch_idx, branch in enumerate(self.branches):
-            status = self._send_message(branch["out_conn"], message)
-            if status["status"]:
-                self._log(f"Sent marker TO {branch['id']}", in_file=True)
+            local_snapshot = self._make_local_snapshot(snapshot)
+            self.local_snapshot_duration.observe(
+                (datetime.now() - snapshot["request_time"]).total_seconds())
 
-            if branch_idx != exclude_index:
-                target = lambda q, arg1: q.put(self._inspect_channel(arg1))
-                threads.append(Thread(target=target,
-                                      args=(que, branch["id"])))
-                threads[-1].start()
+            if snapshot_id[0] != self.id:
+                del self.snapshots[snapshot_id]
 
-        for th in threads:
-            th.join()
+        if snapshot_id[0] == self.id:
+            self._collect_local_snapshot(local_snapshot)
+        else:
+            intitator_idx = self._id_to_index(snapshot_id[0])
+            self._send_message(conn=self.branches[intitator_idx]["out_conn"], message=local_snapshot)
 
-        amounts_in_channels = list(que.queue)
+    def _collect_local_snapshot(self, local_snapshot):
+        """
+        Keeps a local snapshot of a snapshot initiated by this branch.
+        The global snapshot is sent to the inspector once every branch has sent its own.
+        :param local_snapshot: snapshot message.
+        :return: None
+        """
+        snapshot_id = (local_snapshot["initiator"], local_snapshot["seq"])
 
-        return own_state, amounts_in_channels
+        with self.lock:
+            snapshot = self.snapshots[snapshot_id]
+            snapshot["local_snapshots"].append(local_snapshot)
 
-    def _inspect_channel(self, sender_id):
+            if len(snapshot["local_snapshots"]) < self.n_branches:
+                return
 
-        sender_index = self._id_to_index(sender_id)
+            del self.snapshots[snapshot_id]
 
-        amount = 0
+        preparation_time = datetime.now()
+        self.snapshot_duration.observe((preparation_time - snapshot["request_time"]).total_seconds())
 
-        while True:
-            try:
-                if self.branches[sender_index]["last_message"].empty():
-                    continue
+        self._create_global_snapshot(snapshot, preparation_time)
 
-                last_message = self.branches[sender_index]["last_message"].get()
+    def _make_local_snapshot(self, snapshot):
+        """
+        Builds the local snapshot message of this branch.
+        It carries the money in flight on the incoming channels, as columns:
+            sender_ids: id of the sender of each channel.
+            in_flight: the recorded amount.
+        Only the channels with money in flight are sent: the others recorded 0.
+        :param snapshot: state of the snapshot. See _do_snappy_things.
+        :return: the snapshot message.
+        """
+        channels = {index: amount for index, amount in snapshot["channels"].items() if amount}
 
-                if last_message["subject"] == "marker":
-                    return amount
-                elif last_message["subject"] == "transfer":
-                    amount += last_message["amount"]
+        return {
+            "id": self.id,
+            "subject": "snapshot",
+            "balance": snapshot["balance"],
+            "initiator": snapshot["id"][0],
+            "seq": snapshot["id"][1],
+            "sender_ids": array("q", [self.branches[index]["id"] for index in channels]),
+            "in_flight": array("q", channels.values())
+        }
 
-            except TypeError:
-                continue
+    def _create_global_snapshot(self, snapshot, preparation_time):
 
-    def run(self):
+        message = {
+            "subject": "global_snapshot",
+            "initiator": snapshot["id"][0],
+            "seq": snapshot["id"][1],
+            "local_snapshots": [{"id": local["id"],
+                                 "balance": local["balance"],
+                                 "sender_ids": local["sender_ids"],
+                                 "in_flight": local["in_flight"]}
+                                for local in snapshot["local_snapshots"]],
+            "request_time": snapshot["request_time"],
+            "preparation_time": preparation_time
+        }
 
-        threads = []
+        self._send_message(conn=self.inspector["conn"], message=message)
+
+    def stop(self):
+        """
+        Stops the threads of the branch.
+        Blocked threads notice it within `Constants.wait_timeout` seconds.
+        :return: None
+        """
+        self.stopped.set()
+
+        conns = [self.listener, self.inspector["conn"]]
         for branch in self.branches:
+            conns += [branch["in_conn"], branch["out_conn"]]
+
+        for conn in conns:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except (OSError, AttributeError):
+                pass
 
-            threads.append(Thread(target=self._connect_to_branch, args=(branch["id"], "client")))
-            threads[-1].start()
+    def run(self):
 
-            sleep(0.5)
+        self._connect_to_branches()
 
-            threads.append(Thread(target=self._connect_to_branch, args=(branch["id"], "server")))
-            threads[-1].start()
+        # every outgoing connection gets its own writer
+        for branch in self.branches:
+            branch["out_conn"] = Outbox(branch["out_conn"], name=f"writer_to{branch['id']}_th",
+                                        labels={"to": branch["id"]})
+        self.inspector["conn"] = Outbox(self.inspector["conn"], name="writer_to_inspector_th",
+                                        labels={"to": "inspector"})
 
-        for th in threads:
-            th.join()
+        metrics.gauge("bank_delivery_queue", "Received messages waiting for their simulated delay.",
+                      function=lambda: len(self.delivery.heap))
+        # the inspector gets 0
+        self._serve_metrics(1 + self.id)
 
         threads = []
         threads.append(Thread(target=self.do_common, name="do_common_th"))
-        threads.append(
-            Thread(target=self.snapshot_process, name="snapshot_process_th"))
+        threads.append(Thread(target=self._report_periodically, name="reports_th"))
+
+        if self.snpsht_confs['keyboard']:
+            threads.append(
+                Thread(target=self.snapshot_process, name="snapshot_process_th"))
+
+        if self.snpsht_confs['interval']:
+            threads.append(
+                Thread(target=self._schedule_snapshots, name="snapshot_scheduler_th"))
+
+        if self.snpsht_confs['control_port'] is not None:
+            threads.append(Thread(target=self._serve_control, name="control_th"))
 
         for th in threads:
             th.start()
@@ -594,21 +898,32 @@ class Bank(BaseClass):
         for th in threads:
             th.join()
 
-    def _connect_to_branch(self, bid: int, mode: str):
+    def _connect_to_branches(self):
         """
-        Establishes a connection between this branch and the branch with id 'bid'.
-        :param bid: id of the other branch.
-        :param mode: mode of connection establishment. It can be "server" of "client"
+        Establishes the connections between this branch and all other branches.
+        Every branch connects to the listener of every other branch and introduces itself
+        with a hello message, so the accepting side knows whose connection it is.
         :return: None
         """
+        accepter = Thread(target=self._accept_branches, name="accept_th")
+        accepter.start()
 
-        bid = self._id_to_index(bid)
+        # every listener is open since the branches are registered after binding it
+        for branch in self.branches:
+            branch["out_conn"] = transport.connect(branch["endpoint"])
+            branch["out_conn"].sendall(pack_message({"subject": "hello", "id": self.id}))
 
-        if mode == "server":
-            self.branches[bid]["in_conn"], self.branches[bid]["address"] = self.branches[bid]["in_sock"].accept()
+        accepter.join()
 
-        elif mode == "client":
-            while True:
-                address, port = self.branches[bid]["address"], self.branches[bid]["port"]
-                self.branches[bid]["out_conn"].connect((address, port))
-                break
+    def _accept_branches(self):
+        """
+        Accepts the connections of all other branches on the listener of this branch.
+        :return: None
+        """
+        for _ in self.branches:
+            conn, _ = self.listener.accept()
+            reader = FrameReader(conn)
+
+            hello = reader.next_message()
+            branch = self.branches[self._id_to_index(hello["id"])]
+            branch["in_conn"], branch["in_reader"] = conn, reader
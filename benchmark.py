@@ -0,0 +1,401 @@
+"""
+Benchmark of the branches and the inspector.
+
+Every run starts N branches and the inspector as separate processes in a temporary
+directory, with a config generated from config.yml and the load given on the command line.
+The transfers are reported by the inspector (see Inspector._dump_stats), the CPU and memory
+usage of the processes are read from the operating system.
+
+Example:
+    python benchmark.py --branches 3 5 8 --duration 10 --output results.json
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from time import sleep, time
+
+import yaml
+
+from commons import Constants, load_config
+
+
+MAIN = Path(__file__).resolve().parent / "main.py"
+STATS_FILE = "stats.json"
+
+
+def make_config(n_branches: int, args, inspector_port: int) -> dict:
+    """
+    Builds the config of one run.
+    :param n_branches: number of branches.
+    :param args: parsed command line arguments.
+    :param inspector_port: port of the inspector. The branches listen to free ports.
+    :return: the config dictionary.
+    """
+    config = load_config(args.config)
+
+    config['bank']['time_step'] = args.time_step
+    config['bank']['transaction']['p'] = args.p
+    config['bank']['max_n_send'] = 10 ** 9
+    config['bank']['initial_balance'] = 10 ** 9
+    config['bank']['batch'] = {"size": args.batch_size, "delay": args.batch_delay}
+
+    branch = config['branches'][0]
+    branch['port'] = 0
+    branch['transport'] = args.transport
+    branch['delay'] = {"min": args.delay[0], "max": args.delay[1]}
+    config['branches'] = [dict(branch) for _ in range(n_branches)]
+
+    config['snapshot'].update({
+        "keyboard": False,
+        "interval": args.snapshot_interval,
+        "rotate": True,
+        "control_port": None
+    })
+
+    config['inspector']['port'] = inspector_port
+    config['inspector']['transport'] = args.transport
+    config['inspector']['stats_file'] = STATS_FILE
+    config['inspector']['workers'] = args.inspector_workers
+    config['inspector']['ingest'] = args.inspector_ingest
+
+    config['logging'] = dict(config.get('logging', {}), level=args.log_level)
+    # the runs would compete for the ports
+    config['metrics'] = {"port": None}
+
+    return config
+
+
+def read_stats(run_dir: Path):
+    """
+    :return: the last statistics written by the inspector, or None.
+    """
+    try:
+        with open(run_dir / Constants.dir_logs / STATS_FILE) as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def process_usage(pid: int):
+    """
+    Reads the CPU time and memory usage of a process and of its descendants,
+    e.g. the worker processes of the inspector (inspector.workers).
+    psutil is used when it is installed, otherwise /proc (Linux only).
+    :param pid: process id.
+    :return: dictionary with these keys: [cpu_time: seconds, rss: bytes, max_rss: bytes or None,
+        children: number of descendants, children_cpu_time: seconds, children_rss: bytes],
+        or None if it cannot be read. The totals include the descendants, and max_rss
+        is the sum of their peaks.
+    """
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+
+    try:
+        usage = _own_usage(pid, psutil)
+    except Exception:
+        return None
+
+    usage.update(children=0, children_cpu_time=0, children_rss=0)
+    for child in _descendants(pid, psutil):
+        try:
+            child_usage = _own_usage(child, psutil)
+        except Exception:
+            # it has exited
+            continue
+
+        usage["children"] += 1
+        usage["children_cpu_time"] += child_usage["cpu_time"]
+        usage["children_rss"] += child_usage["rss"]
+
+        usage["cpu_time"] += child_usage["cpu_time"]
+        usage["rss"] += child_usage["rss"]
+        if usage["max_rss"] is not None and child_usage["max_rss"] is not None:
+            usage["max_rss"] += child_usage["max_rss"]
+
+    return usage
+
+
+def _own_usage(pid: int, psutil) -> dict:
+    """
+    :return: the usage of the process alone. See process_usage.
+    """
+    if psutil is not None:
+        process = psutil.Process(pid)
+        cpu = process.cpu_times()
+        return {"cpu_time": cpu.user + cpu.system,
+                "rss": process.memory_info().rss,
+                "max_rss": None}
+
+    with open(f"/proc/{pid}/stat") as file:
+        # the fields after the name of the executable, which may contain spaces
+        fields = file.read().rsplit(")", 1)[1].split()
+    ticks = os.sysconf("SC_CLK_TCK")
+
+    memory = {}
+    with open(f"/proc/{pid}/status") as file:
+        for line in file:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "VmHWM"):
+                memory[key] = int(value.split()[0]) * 1024
+
+    return {"cpu_time": (int(fields[11]) + int(fields[12])) / ticks,
+            "rss": memory.get("VmRSS"),
+            "max_rss": memory.get("VmHWM")}
+
+
+def _descendants(pid: int, psutil) -> list:
+    """
+    :return: the ids of the descendant processes of a process.
+    """
+    if psutil is not None:
+        try:
+            return [child.pid for child in psutil.Process(pid).children(recursive=True)]
+        except psutil.Error:
+            return []
+
+    # parent id -> ids of its children
+    children = {}
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(entry / "stat") as file:
+                parent = int(file.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry.name))
+
+    descendants = []
+    pending = [pid]
+    while pending:
+        for child in children.get(pending.pop(), []):
+            descendants.append(child)
+            pending.append(child)
+
+    return descendants
+
+
+def summarize(values: list, scale: float = 1.0):
+    """
+    :param values: samples.
+    :param scale: every value is multiplied by it, e.g. 1000 for seconds to milliseconds.
+    :return: count, mean and percentiles of the samples, or None if there is none.
+    """
+    if not values:
+        return None
+
+    values = sorted(value * scale for value in values)
+
+    def percentile(q):
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(0.50),
+        "p90": percentile(0.90),
+        "p99": percentile(0.99),
+        "max": values[-1]
+    }
+
+
+def start_processes(run_dir: Path, n_branches: int, engine: str) -> list:
+    """
+    Starts the branches and the inspector.
+    :return: list of dictionaries with these keys: [role: str, id: int or None, process: Popen]
+    """
+    processes = []
+
+    def start(role, bid, option):
+        output = open(run_dir / f"{role}{'' if bid is None else '_' + str(bid)}.out", "w")
+        process = subprocess.Popen(
+            [sys.executable, str(MAIN), option] + (["-e", engine] if role == "branch" else []),
+            cwd=run_dir, stdout=output, stderr=subprocess.STDOUT)
+        processes.append({"role": role, "id": bid, "process": process})
+
+    for bid in range(n_branches):
+        start("branch", bid, "-b")
+
+    start("inspector", None, "-i")
+
+    return processes
+
+
+def stop_processes(processes: list):
+
+    for entry in processes:
+        entry["process"].terminate()
+
+    for entry in processes:
+        try:
+            entry["process"].wait(5)
+        except subprocess.TimeoutExpired:
+            entry["process"].kill()
+
+
+def run_benchmark(n_branches: int, args) -> dict:
+    """
+    Runs the system with n_branches branches and measures it.
+    :return: results of the run.
+    """
+    run_dir = Path(tempfile.mkdtemp(prefix=f"bench_{n_branches}_"))
+    # a free port, released right away for the inspector
+    with socket.create_server(('localhost', 0)) as sock:
+        inspector_port = sock.getsockname()[1]
+
+    with open(run_dir / Constants.config_file, "w") as file:
+        yaml.safe_dump(make_config(n_branches, args, inspector_port), file)
+
+    processes = start_processes(run_dir, n_branches, args.engine)
+
+    try:
+        # ready when the first transfer has been matched
+        deadline = time() + args.startup_timeout
+        while True:
+            stats = read_stats(run_dir)
+            if stats is not None and stats["matched"] > 0:
+                break
+
+            for entry in processes:
+                if entry["process"].poll() is not None:
+                    raise RuntimeError(f"The {entry['role']} {entry['id']} exited. "
+                                       f"See the outputs in {run_dir}")
+
+            if time() > deadline:
+                raise RuntimeError(f"The system was not ready after {args.startup_timeout} "
+                                   f"seconds. See the outputs in {run_dir}")
+            sleep(0.1)
+
+        sleep(args.warmup)
+
+        first = read_stats(run_dir)
+        first_usage = [process_usage(entry["process"].pid) for entry in processes]
+        first_time = time()
+
+        sleep(args.duration)
+
+        last_usage = [process_usage(entry["process"].pid) for entry in processes]
+        elapsed = time() - first_time
+
+        # the statistics are written every second, later if the inspector is overloaded
+        last = read_stats(run_dir)
+        while last["time"] < first_time + args.duration:
+            if time() > first_time + args.duration + args.startup_timeout:
+                raise RuntimeError(f"The inspector stopped writing its statistics. "
+                                   f"See the outputs in {run_dir}")
+            sleep(0.1)
+            last = read_stats(run_dir)
+    finally:
+        stop_processes(processes)
+
+    if not args.keep:
+        shutil.rmtree(run_dir)
+
+    usage = []
+    for entry, before, after in zip(processes, first_usage, last_usage):
+        if before is None or after is None:
+            usage.append({"role": entry["role"], "id": entry["id"]})
+            continue
+
+        usage.append({
+            "role": entry["role"],
+            "id": entry["id"],
+            "cpu_percent": 100 * (after["cpu_time"] - before["cpu_time"]) / elapsed,
+            "rss_mb": after["rss"] / 2 ** 20,
+            "max_rss_mb": None if after["max_rss"] is None else after["max_rss"] / 2 ** 20,
+            # included in the above, e.g. the workers of the inspector
+            "children": after["children"],
+            "children_cpu_percent": 100 * (after["children_cpu_time"] - before["children_cpu_time"]) / elapsed,
+            "children_rss_mb": after["children_rss"] / 2 ** 20
+        })
+
+    matched = last["matched"] - first["matched"]
+    lookups = last["lookups"] - first["lookups"]
+
+    # the inspector keeps samples since it started: only those of the measurement are summarized
+    def measured(sample_time):
+        return first["time"] <= sample_time <= last["time"]
+
+    latencies = [latency for sample_time, latency in last["latencies"] if measured(sample_time)]
+    snapshots = [snapshot for snapshot in last["snapshots"] if measured(snapshot["time"])]
+
+    return {
+        "n_branches": n_branches,
+        "engine": args.engine,
+        "duration": last["time"] - first["time"],
+        "transfers_per_sec": matched / (last["time"] - first["time"]),
+        "transfer_latency_ms": summarize(latencies, 1000),
+        "snapshot_latency_ms": summarize([s["latency"] for s in snapshots], 1000),
+        "snapshots": snapshots,
+        "inspector": {
+            "lookups": lookups,
+            "mean_lookup_us": (last["lookup_ns"] - first["lookup_ns"]) / max(lookups, 1) / 1000,
+            "pending_reports": last["pending"]
+        },
+        "processes": usage
+    }
+
+
+if __name__ == '__main__':
+
+    ap = argparse.ArgumentParser(description="Measures the throughput of the transfers "
+                                             "and the latency of the snapshots.")
+
+    ap.add_argument("-n", "--branches", type=int, nargs="+", default=[3],
+                    help="Numbers of branches. The system is measured once for each of them.")
+    ap.add_argument("-e", "--engine", default="threads", choices=["threads", "asyncio"])
+    ap.add_argument("-t", "--transport", default="tcp", choices=["tcp", "unix", "shm"],
+                    help="Transport of all channels.")
+    ap.add_argument("--duration", type=float, default=10,
+                    help="Seconds of measurement of each run.")
+    ap.add_argument("--warmup", type=float, default=2,
+                    help="Seconds between the first matched transfer and the measurement.")
+    ap.add_argument("--startup-timeout", type=float, default=60)
+    ap.add_argument("--time-step", type=float, default=0.01,
+                    help="bank.time_step of the branches.")
+    ap.add_argument("-p", type=float, default=1.0,
+                    help="Probability of a transfer to each branch at every time step.")
+    ap.add_argument("--delay", type=int, nargs=2, default=[0, 0], metavar=("MIN", "MAX"),
+                    help="Delay of the channels in time steps.")
+    ap.add_argument("--batch-size", type=int, default=1,
+                    help="bank.batch.size: transfers per message. 1 disables batching.")
+    ap.add_argument("--batch-delay", type=float, default=0.05,
+                    help="bank.batch.delay: seconds a batched transfer may wait.")
+    ap.add_argument("--snapshot-interval", type=float, default=1.0,
+                    help="Seconds between two snapshots. 0 disables them.")
+    ap.add_argument("--inspector-workers", type=int, default=0,
+                    help="inspector.workers: processes which match the events (see sharding.py).")
+    ap.add_argument("--inspector-ingest", default="selectors", choices=["selectors", "threads"],
+                    help="inspector.ingest: read the branches on one thread or on a thread each.")
+    ap.add_argument("--log-level", default="info", choices=["debug", "info", "warning", "error"])
+    ap.add_argument("--config", default=None, help="Base config file. Default: config.yml")
+    ap.add_argument("--keep", action="store_true",
+                    help="Keep the directories of the runs (config, logs and outputs).")
+    ap.add_argument("-o", "--output", default=None,
+                    help="File of the JSON results. They are printed when it is not given.")
+
+    args = ap.parse_args()
+
+    if min(args.branches) < 2:
+        ap.error("At least 2 branches are needed.")
+
+    results = {
+        "time": time(),
+        "python": sys.version.split()[0],
+        "args": vars(args),
+        "runs": [run_benchmark(n, args) for n in args.branches]
+    }
+
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
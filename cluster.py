@@ -0,0 +1,203 @@
+"""
+Runs the inspector and N branches as processes of this machine (see main.py --cluster).
+
+The branches get a config generated from config.yml with N branches, which is written
+to bank/cluster.yml, so the port of every branch id is known before it starts.
+The ids themselves are assigned by the registry when the branches register.
+On Linux, the processes are spread over the CPU cores this process may run on.
+"""
+import os
+import shutil
+import signal
+import subprocess
+import sys
+from pathlib import Path
+from time import sleep, time
+
+import yaml
+
+from bank import send_command
+from commons import Constants, load_config
+from registry import Registry
+
+
+MAIN = Path(__file__).resolve().parent / "main.py"
+CONFIG_FILE = Constants.dir_bank / "cluster.yml"
+
+
+def make_config(n_branches: int, config_path=None) -> dict:
+    """
+    Builds the config of a cluster from a config file.
+    Branch i gets the settings of branch i of the file, or of its last branch if the file
+    has fewer. Unless it is 0 (a free port), the port of branch i is the port of the first
+    branch plus i.
+    :param n_branches: number of branches.
+    :param config_path: the config file. Constants.config_file by default.
+    :return: the config dictionary.
+    """
+    config = load_config(config_path)
+
+    branches = config['branches']
+    first_port = branches[0]['port']
+    config['branches'] = []
+    for bid in range(n_branches):
+        branch = dict(branches[min(bid, len(branches) - 1)])
+        branch['port'] = first_port + bid if first_port else 0
+        config['branches'].append(branch)
+
+    # the branches run without a terminal
+    config['snapshot']['keyboard'] = False
+
+    return config
+
+
+def cpu_cores() -> list:
+    """
+    :return: the CPU cores this process may run on, or an empty list if the processes
+        cannot be pinned to cores on this platform.
+    """
+    if not hasattr(os, "sched_setaffinity"):
+        return []
+
+    return sorted(os.sched_getaffinity(0))
+
+
+class Cluster:
+    """
+    The processes of a cluster, started in the current directory.
+    """
+
+    def __init__(self, n_branches: int, engine: str = "threads", config_path=None,
+                 startup_timeout: float = 60):
+        """
+        :param n_branches: number of branches.
+        :param engine: engine of the branches. See main.py --engine.
+        :param config_path: base config file. See make_config.
+        :param startup_timeout: seconds to wait for the branches to be ready.
+        """
+        self.n_branches = n_branches
+        self.engine = engine
+        self.config = make_config(n_branches, config_path)
+        self.startup_timeout = startup_timeout
+        self.cores = cpu_cores()
+        # list of dictionaries with these keys: [role: str, process: Popen]
+        self.processes = []
+
+    def start(self):
+        """
+        Starts the inspector and the branches, and waits until every branch is ready.
+        :return: None
+        """
+        # the registry of a previous run would give the branches wrong ids
+        shutil.rmtree(Constants.dir_bank, ignore_errors=True)
+        registry = Registry(Constants.dir_bank)
+        Constants.dir_logs.mkdir(exist_ok=True)
+
+        with open(CONFIG_FILE, "w") as file:
+            yaml.safe_dump(self.config, file)
+
+        # the inspector prints the global snapshots on the terminal.
+        # With workers, it is not pinned, as they would inherit its core (see sharding.py).
+        self._start("inspector", ["-i"], output=None, pin=self.config['inspector']['workers'] == 0)
+
+        for i in range(self.n_branches):
+            self._start("branch", ["-b", "-e", self.engine],
+                        output=Constants.dir_logs / f"branch_process_{i}.out")
+
+        deadline = time() + self.startup_timeout
+
+        # every branch listens once it is registered
+        while len(registry.members()) < self.n_branches:
+            self._check(deadline)
+            sleep(0.1)
+
+        # and it serves its control port once it is connected to the others and the inspector
+        control_port = self.config['snapshot']['control_port']
+        if control_port is not None:
+            for bid in range(self.n_branches):
+                while True:
+                    try:
+                        send_command(bid, "ping", control_port)
+                        break
+                    except ConnectionRefusedError:
+                        self._check(deadline)
+                        sleep(0.1)
+
+    def _start(self, role: str, options: list, output, pin: bool = True):
+        """
+        Starts a process of the cluster.
+        :param role: "inspector" or "branch".
+        :param options: command line options of main.py.
+        :param output: file of its output, or None for the terminal.
+        :param pin: pin it to the next core, if the platform allows it.
+        :return: None
+        """
+
+        if output is not None:
+            output = open(output, "w")
+
+        # in their own session, so Ctrl-C on the terminal only interrupts this process.
+        # The branches are stopped by stop().
+        process = subprocess.Popen(
+            [sys.executable, str(MAIN), "--config", str(CONFIG_FILE)] + options,
+            stdout=output, stderr=subprocess.STDOUT if output is not None else None,
+            start_new_session=True)
+
+        if self.cores and pin:
+            core = self.cores[len(self.processes) % len(self.cores)]
+            try:
+                os.sched_setaffinity(process.pid, {core})
+            except ProcessLookupError:
+                # it has already exited, which _check reports
+                pass
+
+        self.processes.append({"role": role, "process": process})
+
+    def _check(self, deadline: float):
+        """
+        Raises RuntimeError if a process has exited or the deadline has passed.
+        """
+        for i, entry in enumerate(self.processes):
+            if entry["process"].poll() is not None:
+                raise RuntimeError(f"The {entry['role']} process {i} exited "
+                                   f"with code {entry['process'].returncode}.")
+
+        if time() > deadline:
+            raise RuntimeError(f"The cluster was not ready after {self.startup_timeout} seconds.")
+
+    def wait(self):
+        """
+        Blocks until a process exits.
+        :return: None
+        """
+        while all(entry["process"].poll() is None for entry in self.processes):
+            sleep(Constants.wait_timeout)
+
+    def stop(self, timeout: float = 10):
+        """
+        Interrupts the branches, as Ctrl-C would. The inspector stops when they are closed.
+        Processes which are still running after `timeout` seconds are killed.
+        :param timeout: seconds.
+        :return: None
+        """
+        for entry in self.processes:
+            if entry["role"] == "branch" and entry["process"].poll() is None:
+                entry["process"].send_signal(signal.SIGINT)
+
+        deadline = time() + timeout
+        for entry in self.processes:
+            try:
+                entry["process"].wait(max(deadline - time(), 0))
+            except subprocess.TimeoutExpired:
+                entry["process"].kill()
+                entry["process"].wait()
+
+    @staticmethod
+    def teardown(keep_logs: bool = False):
+        """
+        Removes bank/ and, unless keep_logs, logs/.
+        :return: None
+        """
+        shutil.rmtree(Constants.dir_bank, ignore_errors=True)
+        if not keep_logs:
+            shutil.rmtree(Constants.dir_logs, ignore_errors=True)
@@ -0,0 +1,250 @@
+import asyncio
+import pickle
+import struct
+import sys
+from array import array
+
+
+# Every frame starts with the length of its payload.
+HEADER = struct.Struct("!I")
+
+# Messages without a fixed layout are pickled after this tag.
+TAG_PICKLE = 0
+
+
+class Record:
+    """
+    Fixed layout of one message subject.
+    The payload is a one byte tag followed by the fields packed with `layout`.
+    """
+
+    def __init__(self, subject: str, tag: int, layout: str, fields: tuple):
+        self.subject = subject
+        self.tag = tag
+        self.fields = fields
+        # keys of the messages of this layout, with the subject
+        self.n_keys = len(fields) + 1
+        self.payload = struct.Struct("!B" + layout)
+        # length prefix and payload are packed in one go when sending
+        self.frame = struct.Struct("!IB" + layout)
+
+    def pack(self, message) -> bytes:
+        return self.frame.pack(self.payload.size, self.tag, *[message[field] for field in self.fields])
+
+    def unpack(self, buffer, offset: int) -> dict:
+        values = self.payload.unpack_from(buffer, offset)
+
+        message = {"subject": self.subject}
+        for field, value in zip(self.fields, values[1:]):
+            message[field] = value
+
+        return message
+
+
+class ColumnRecord:
+    """
+    Layout of a message which carries columns of integers of the same length.
+    The payload is a one byte tag, the fields packed with `layout`, the length of
+    the columns and the columns one after another, each item as a signed 8 byte integer.
+    Columns are unpacked as array("q"). Times are sent in columns as nanoseconds since
+    the epoch.
+    """
+
+    def __init__(self, subject: str, tag: int, layout: str, fields: tuple, columns: tuple):
+        self.subject = subject
+        self.tag = tag
+        self.fields = fields
+        self.columns = columns
+        self.n_keys = len(fields) + len(columns) + 1
+        self.payload = struct.Struct("!B" + layout + "I")
+        self.frame = struct.Struct("!IB" + layout + "I")
+
+    def pack(self, message) -> bytes:
+        columns = [array("q", message[name]) for name in self.columns]
+        if _SWAP:
+            for column in columns:
+                column.byteswap()
+        body = b"".join(column.tobytes() for column in columns)
+
+        return self.frame.pack(self.payload.size + len(body), self.tag,
+                               *[message[field] for field in self.fields], len(columns[0])) + body
+
+    def unpack(self, buffer, offset: int) -> dict:
+        values = self.payload.unpack_from(buffer, offset)
+        size = values[-1] * 8
+        offset += self.payload.size
+
+        message = {"subject": self.subject}
+        for field, value in zip(self.fields, values[1:-1]):
+            message[field] = value
+        for name in self.columns:
+            column = array("q")
+            column.frombytes(buffer[offset:offset + size])
+            if _SWAP:
+                column.byteswap()
+            message[name] = column
+            offset += size
+
+        return message
+
+
+# columns are sent in network byte order (big-endian)
+_SWAP = sys.byteorder == "little"
+
+
+RECORDS = [
+    Record("transfer", 1, "qq", ("amount", "seq")),
+    Record("marker", 2, "iq", ("initiator", "seq")),
+    # local snapshot, with the money in flight on its incoming channels
+    ColumnRecord("snapshot", 3, "iqiq", ("id", "balance", "initiator", "seq"),
+                 ("sender_ids", "in_flight")),
+    # first message of every connection, it identifies the connecting branch
+    Record("hello", 6, "i", ("id", )),
+    # consecutive transfers of a channel, starting from the transfer number seq
+    ColumnRecord("transfers", 7, "q", ("seq", ), ("amounts", )),
+    # events of a branch for the inspector. See events.EventBuffer.
+    ColumnRecord("sends", 8, "i", ("sender_id", ),
+                 ("receiver_ids", "amounts", "seqs", "send_times")),
+    ColumnRecord("receives", 9, "i", ("receiver_id", ),
+                 ("sender_ids", "amounts", "seqs", "receive_times")),
+]
+
+_by_subject = {record.subject: record for record in RECORDS}
+_by_tag = {record.tag: record for record in RECORDS}
+
+
+def pack_message(message: dict) -> bytes:
+    """
+    Packs a message into a frame ready to be sent.
+    :param message: a dictionary with at least the "subject" key.
+    :return: length prefix followed by the payload.
+    """
+    record = _by_subject.get(message["subject"])
+
+    # The fixed layout is only used when it carries every key of the message.
+    if record is not None and len(message) == record.n_keys:
+        try:
+            return record.pack(message)
+        except (KeyError, TypeError, AttributeError, struct.error):
+            pass
+
+    payload = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return HEADER.pack(len(payload) + 1) + bytes((TAG_PICKLE, )) + payload
+
+
+def unpack_message(buffer, offset: int, size: int) -> dict:
+    """
+    Unpacks the payload of a frame.
+    :param buffer: bytes-like object containing the payload.
+    :param offset: index of the first byte of the payload.
+    :param size: size of the payload.
+    :return: the message dictionary.
+    """
+    record = _by_tag.get(buffer[offset])
+
+    if record is None:
+        return pickle.loads(buffer[offset + 1: offset + size])
+
+    return record.unpack(buffer, offset)
+
+
+async def read_message(reader):
+    """
+    Reads the next message from an asyncio stream.
+    :param reader: asyncio.StreamReader
+    :return: the message, or None if the stream was closed.
+    """
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError:
+        return None
+
+    size, = HEADER.unpack(header)
+    payload = await reader.readexactly(size)
+
+    return unpack_message(payload, 0, size)
+
+
+class FrameReader:
+    """
+    Reads frames from a connection into a reusable buffer and yields the messages.
+    Frames may be split across reads or several of them may arrive in one read;
+    both are handled.
+    """
+
+    def __init__(self, conn, buffer_size: int = 64 * 1024):
+        self.conn = conn
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first byte not consumed yet
+        self.end = 0  # end of the received data
+
+    def __iter__(self):
+        while True:
+            yield from self.messages()
+
+            if not self.fill():
+                return
+
+    def next_message(self):
+        """
+        Reads the next message. The following ones are kept for the next reads.
+        :return: the message, or None if the connection was closed.
+        """
+        return next(iter(self), None)
+
+    def fill(self) -> int:
+        """
+        Receives more data from the connection.
+        :return: number of received bytes. Zero means the connection was closed.
+        """
+        if self.end == len(self.buffer):
+            self._make_room()
+
+        n_bytes = self.conn.recv_into(self.view[self.end:])
+        self.end += n_bytes
+
+        return n_bytes
+
+    def messages(self):
+        """
+        Yields the messages of the complete frames which are in the buffer.
+        """
+        buffer = self.buffer
+        header_size = HEADER.size
+
+        while self.end - self.start >= header_size:
+            size, = HEADER.unpack_from(buffer, self.start)
+            offset = self.start + header_size
+
+            if self.end - offset < size:
+                # grow the buffer in advance if the frame cannot fit in it
+                if size + header_size > len(buffer):
+                    self._make_room(size + header_size)
+                return
+
+            self.start = offset + size
+            yield unpack_message(buffer, offset, size)
+
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def _make_room(self, needed: int = 0):
+        """
+        Moves the unread data to the beginning of the buffer.
+        The buffer is enlarged if it still has no room for `needed` bytes or more data.
+        """
+        pending = self.end - self.start
+        size = len(self.buffer)
+
+        if pending >= size or needed > size:
+            self.view.release()
+            buffer = bytearray(max(2 * size, needed))
+            buffer[:pending] = self.buffer[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(self.buffer)
+        else:
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+
+        self.start, self.end = 0, pending
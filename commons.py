@@ -1,9 +1,12 @@
 import os
 from pathlib import Path
-from datetime import datetime
+from time import sleep, monotonic
 
 import yaml
 
+from logger import log_writer
+from metrics import metrics
+
 # Windows
 if os.name == 'nt':
     import msvcrt
@@ -20,6 +23,8 @@ class Constants:
     dir_logs = Path("logs/")
     dir_bank = Path("bank/")
     config_file = Path('config.yml')
+    # seconds a blocked thread waits before checking whether it should stop
+    wait_timeout = 0.5
 
 class KBHit:
 
@@ -73,7 +78,8 @@ class KBHit:
         if os.name == 'nt':
             return msvcrt.getch().decode('utf-8')
         else:
-            return sys.stdin.read(1)
+            # bypass the buffer of sys.stdin, otherwise kbhit() misses the buffered keys
+            return os.read(self.fd, 1).decode('utf-8', errors='ignore')
 
     def getarrow(self):
         """Returns an arrow-key code after kbhit() has been called. Codes are
@@ -95,34 +101,67 @@ class KBHit:
 
         return vals.index(ord(c.decode('utf-8')))
 
-    def kbhit(self):
+    def kbhit(self, timeout: float = 0):
         """
         Returns True if keyboard character was hit, False otherwise.
+        Waits up to `timeout` seconds for a key to be hit.
         """
         if os.name == 'nt':
-            return msvcrt.kbhit()
+            deadline = monotonic() + timeout
+            while not msvcrt.kbhit():
+                if monotonic() >= deadline:
+                    return False
+                sleep(0.01)
+            return True
         else:
-            dr,dw,de = select([sys.stdin], [], [], 0)
+            dr,dw,de = select([sys.stdin], [], [], timeout)
             return dr != []
 
 
-class BaseClass:
+def load_config(path=None):
     """
-    Base class for both bank and inspector
+    Reads the yaml config file.
+    :param path: path of the config file. Constants.config_file by default.
+    :return: the configuration dictionary.
     """
+    if path is None:
+        path = Constants.config_file
 
-    def _log(self, message, stdio: bool = True, in_file: bool = False, file_mode: str = "a"):
+    with open(path, 'r') as yaml_file:
+        return yaml.load(yaml_file, Loader=yaml.FullLoader)
 
-        prefix = datetime.now().strftime("%Y-%m-%d:%H:%M:%S ")
 
-        output_string = f"{prefix}{message}"
+class BaseClass:
+    """
+    Base class for both bank and inspector
+    """
 
-        if stdio:
-            print(output_string)
+    def _log(self, message, *args, stdio: bool = True, in_file: bool = False,
+             file_mode: str = "a", level: str = "info"):
+        """
+        Logs a message with a timestamp.
+        The record is only queued here. It is written by the log writer of the process.
+        :param message: the message, or a str.format template when args are given.
+            Hot paths pass args, so the formatting happens on the writer thread.
+        :param stdio: print the message.
+        :param in_file: write the message in the log file of this object (self.log_database).
+        :param file_mode: "w" truncates the log file first.
+        :param level: "debug", "info", "warning" or "error".
+        :return: None
+        """
+        path = self.log_database if in_file else None
+        log_writer.log(message, args, stdio, path, file_mode, level)
 
-        if in_file:
-            with open(self.log_database, mode=file_mode) as f:
-                f.write(output_string + "\n")
+    def _serve_metrics(self, offset: int):
+        """
+        Serves the metrics of the process on port `metrics.port + offset` (see metrics.py),
+        unless the port is null.
+        :param offset: 0 for the inspector, 1 + id for the branches.
+        :return: None
+        """
+        port = self.config['metrics']['port']
+        if port is not None:
+            metrics.serve(port + offset)
 
     def _id_to_index(self, bid: int) -> int:
         for i, branch in enumerate(self.branches):
@@ -135,12 +174,19 @@ class BaseClass:
         Gets and prepares configurations from yaml config file
         """
 
-        if path is None:
-            path = Constants.config_file
-
-        with open(path, 'r') as yaml_file:
-            self.config = yaml.load(yaml_file, Loader=yaml.FullLoader)
+        self.config = load_config(path)
 
         self.brnch_confs = self.config['branches']
         self.bank_confs = self.config['bank']
         self.inspctr_confs = self.config['inspector']
+        self.snpsht_confs = self.config['snapshot']
+
+        log_writer.configure(**self.config.get('logging', {}))
+
+        # currency formatting used in the log messages
+        c_sign = self.bank_confs['currency']['symbol']
+        c_unit = self.bank_confs['currency']['unit']
+        s_place = self.bank_confs['currency']['placement']
+        self.sign_before = f'{c_sign if s_place == "before" else ""}'
+        sign_after = f'{c_sign if s_place == "after" else ""}'
+        self.merged_unit_sign_after = c_unit + ' ' + sign_after
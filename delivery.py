@@ -0,0 +1,69 @@
+import heapq
+from itertools import count
+from threading import Condition
+from time import monotonic
+
+from commons import Constants
+
+
+class DelayedDelivery:
+    """
+    Holds received messages until their delivery time, to simulate the latency of the channels.
+    Messages wait in a heap ordered by delivery time and a single thread delivers them
+    when they are due, so a delayed message never blocks the reception of the next ones.
+    A message is never delivered before an earlier message of the same channel: its delivery
+    time is at least the delivery time of the previous one (FIFO channels).
+    """
+
+    def __init__(self, deliver):
+        """
+        :param deliver: function called with (channel, message) when a message is due.
+        """
+        self.deliver = deliver
+        # (delivery time, arrival order, channel, message)
+        self.heap = []
+        self.order = count()
+        # channel -> delivery time of its last message
+        self.last = {}
+        self.condition = Condition()
+
+    def put(self, channel, message, delay: float):
+        """
+        Schedules the delivery of a message. It can be called from any thread.
+        :param channel: the channel the message came from.
+        :param message: the message.
+        :param delay: seconds to wait before delivering it.
+        :return: None
+        """
+        with self.condition:
+            delivery_time = max(monotonic() + delay, self.last.get(channel, 0))
+            self.last[channel] = delivery_time
+
+            heapq.heappush(self.heap, (delivery_time, next(self.order), channel, message))
+
+            # the delivery thread only has to wake up if this message is the next one
+            if self.heap[0][3] is message:
+                self.condition.notify()
+
+    def run(self, stopped):
+        """
+        Delivers the messages when they are due, until `stopped` is set.
+        :param stopped: threading.Event
+        :return: None
+        """
+        heap = self.heap
+
+        while not stopped.is_set():
+            with self.condition:
+                now = monotonic()
+                if not heap or heap[0][0] > now:
+                    timeout = Constants.wait_timeout if not heap else heap[0][0] - now
+                    self.condition.wait(min(timeout, Constants.wait_timeout))
+                    continue
+
+                due = []
+                while heap and heap[0][0] <= now:
+                    due.append(heapq.heappop(heap))
+
+            for _, _, channel, message in due:
+                self.deliver(channel, message)
@@ -0,0 +1,62 @@
+from array import array
+from threading import Lock
+
+
+class EventBuffer:
+    """
+    Events of one kind (e.g. the sends of a branch) which are waiting to be reported.
+    They are kept in columns of 8 byte integers and taken out as one message,
+    which the codec packs without pickling. See codec.ColumnRecord.
+    """
+
+    def __init__(self, subject: str, fields: dict, columns: tuple, max_events: int):
+        """
+        :param subject: subject of the messages.
+        :param fields: fixed fields of the messages, e.g. the id of the branch.
+        :param columns: names of the columns. Every event has one value per column.
+        :param max_events: the events are taken out when this many are buffered.
+        """
+        self.subject = subject
+        self.fields = fields
+        self.names = columns
+        self.max_events = max_events
+        self.lock = Lock()
+        self.columns = self._new_columns()
+
+    def add(self, *values):
+        """
+        Buffers an event. It can be called from any thread.
+        :param values: one value per column.
+        :return: the message of the buffered events if the buffer is full, None otherwise.
+        """
+        with self.lock:
+            for column, value in zip(self.columns, values):
+                column.append(value)
+
+            if len(self.columns[0]) < self.max_events:
+                return None
+
+            return self._take()
+
+    def take(self):
+        """
+        :return: the message of the buffered events, or None if there is none.
+        """
+        with self.lock:
+            if not self.columns[0]:
+                return None
+
+            return self._take()
+
+    def _take(self):
+
+        message = {"subject": self.subject}
+        message.update(self.fields)
+        message.update(zip(self.names, self.columns))
+
+        self.columns = self._new_columns()
+
+        return message
+
+    def _new_columns(self):
+        return [array("q") for _ in self.names]
@@ -0,0 +1,96 @@
+import numpy as np
+
+
+class GlobalState:
+    """
+    State of the system recorded by a global snapshot, as NumPy arrays.
+    Branches are indexed by their position in the sorted branch ids:
+        balances[i]: recorded balance of branch i.
+        channels[s, r]: money in flight from branch s to branch r.
+    """
+
+    def __init__(self, message: dict, branch_ids):
+        """
+        :param message: global_snapshot message. See Bank._create_global_snapshot.
+        :param branch_ids: ids of all branches.
+        """
+        self.ids = np.sort(np.asarray(branch_ids, dtype=np.int64))
+        n_branches = len(self.ids)
+
+        local_snapshots = message["local_snapshots"]
+
+        receivers = np.searchsorted(self.ids, [local["id"] for local in local_snapshots])
+        self.balances = np.zeros(n_branches, dtype=np.int64)
+        self.balances[receivers] = [local["balance"] for local in local_snapshots]
+
+        # the incoming channels which a local snapshot does not carry had no money in flight
+        senders = [np.asarray(local["sender_ids"], dtype=np.int64) for local in local_snapshots]
+        amounts = [np.asarray(local["in_flight"], dtype=np.int64) for local in local_snapshots]
+
+        self.channels = np.zeros((n_branches, n_branches), dtype=np.int64)
+        if senders:
+            self.channels[
+                np.searchsorted(self.ids, np.concatenate(senders)),
+                np.repeat(receivers, [len(column) for column in senders])
+            ] = np.concatenate(amounts)
+
+    @classmethod
+    def from_arrays(cls, ids, balances, channels):
+        """
+        Builds a state from its arrays, e.g. when it is read back from a SnapshotStore.
+        :param ids: sorted ids of the branches.
+        :param balances: balance of each branch.
+        :param channels: N x N matrix of the money in flight.
+        :return: the state.
+        """
+        state = cls.__new__(cls)
+        state.ids = ids
+        state.balances = balances
+        state.channels = channels
+
+        return state
+
+    @property
+    def inflow(self):
+        """
+        :return: money in flight towards each branch.
+        """
+        return self.channels.sum(axis=0)
+
+    @property
+    def outflow(self):
+        """
+        :return: money in flight from each branch.
+        """
+        return self.channels.sum(axis=1)
+
+    @property
+    def in_flight(self) -> int:
+        return int(self.channels.sum())
+
+    @property
+    def total(self) -> int:
+        """
+        :return: money of the system: the balances and the money in flight.
+        """
+        return int(self.balances.sum()) + self.in_flight
+
+    def hot_channels(self, n_channels: int) -> list:
+        """
+        :param n_channels: maximum number of channels.
+        :return: the channels with the most money in flight, as
+            (sender id, receiver id, amount), the largest first. Empty channels are left out.
+        """
+        flat = self.channels.ravel()
+        n_channels = min(n_channels, flat.size)
+        if n_channels == 0:
+            return []
+
+        top = np.argpartition(flat, -n_channels)[-n_channels:]
+        top = top[np.argsort(flat[top])[::-1]]
+        top = top[flat[top] > 0]
+
+        senders, receivers = np.unravel_index(top, self.channels.shape)
+
+        return [(int(self.ids[s]), int(self.ids[r]), int(flat[i]))
+                for s, r, i in zip(senders, receivers, top)]
@@ -1,15 +1,31 @@
-import pickle
 import threading
-import socket
-import random
+import json
+import os
+import selectors
+from collections import deque
 from threading import Thread
+from time import time, time_ns, sleep, perf_counter_ns
 
 from commons import Constants, BaseClass
+from metrics import metrics
+from codec import FrameReader
 from bank import Bank
+from global_state import GlobalState
+from matching import TransferMatcher, new_stats, record_transfers, log_transfers
+from sharding import ShardedMatcher
+from snapshot_store import SnapshotStore
+import transport
 
 
 class Inspector(BaseClass):
 
+    # latencies of matched transfers kept per branch for the statistics
+    max_latency_samples = 1_000
+    # latest global snapshots kept for the statistics
+    max_snapshot_stats = 10_000
+    # channels with the most money in flight, logged with every global snapshot
+    n_hot_channels = 3
+
     def __init__(self, address='localhost'):
 
         self.get_config()
@@ -21,173 +37,379 @@ class Inspector(BaseClass):
         self.n_branches = len(self.brnch_confs)
 
         self.branches = []
-        self.received_messages = []
-        self.sent_messages = []
         self.lock = threading.Lock()
         self.n_global_snapshots = 0
 
         self.log_database = Constants.dir_logs / self.inspctr_confs['log_file']
 
+        # Statistics of the run, periodically written to this file (see _dump_stats).
+        # It is used by benchmark.py. null disables them.
+        self.stats_file = self.inspctr_confs['stats_file']
+        self.snapshot_stats = deque(maxlen=self.max_snapshot_stats)
+
+        # binary copy of the global snapshots, for random access. See snapshot_store.
+        self.snapshot_store = None
+        if self.inspctr_confs['snapshot_store'] is not None:
+            Constants.dir_logs.mkdir(exist_ok=True)
+            self.snapshot_store = SnapshotStore(Constants.dir_logs, self.inspctr_confs['snapshot_store'])
+
+        # money of the system, which every global snapshot must add up to
+        initial_balance = self.bank_confs['initial_balance']
+        if initial_balance is None:
+            initial_balance = 1_000_000
+        self.expected_total = initial_balance * self.n_branches
+
         self.connect_to_branches()
 
+        # Unmatched events are spilled once a global snapshot shows that their other side
+        # will not come, or when there are too many of them. See TransferMatcher.collect.
+        self.pending_grace = self.inspctr_confs['pending']['grace']
+
+        # The events are matched by the threads of the branches, or by worker processes
+        # which own a share of the channels each. See sharding.py.
+        branch_ids = [branch["id"] for branch in self.branches]
+        self.matcher = None
+        self.shards = None
+        if self.inspctr_confs['workers'] > 0:
+            self.shards = ShardedMatcher(self.inspctr_confs['workers'], branch_ids,
+                                         self._receive_shard_report, self.max_latency_samples)
+        else:
+            spill_file = self.inspctr_confs['pending']['spill_file']
+            self.matcher = TransferMatcher(
+                branch_ids, max_events=self.inspctr_confs['pending']['max_events'],
+                spill_path=None if spill_file is None else Constants.dir_logs / spill_file)
+
+        self._init_metrics()
+
         self._log("INSPECTOR LOG\n", in_file=True, stdio=False, file_mode="w")
 
     def connect_to_branches(self):
 
+        # All branches connect to this single listener. They are identified by the
+        # hello message which starts every connection. See accept_branches.
+        endpoint = transport.make_endpoint(self.inspctr_confs,
+                                           Constants.dir_bank / "inspector.sock", self.address)
+        self.listener, _ = transport.listen(endpoint, backlog=self.n_branches)
+
         self._log("Waiting for branches ...")
 
-        while True:
-            Bank.load_class_vars()
-            if len(Bank.branches_public_details) == self.n_branches:
-                self._log(f"All {self.n_branches} branches are open now. Resuming the process.")
-                break
+        Bank.wait_for_branches(self.n_branches)
+        self._log(f"All {self.n_branches} branches are open now. Resuming the process.")
 
         for i in range(self.n_branches):
             self.branches.append({
                 "id": Bank.branches_public_details[i]["id"],
                 "address": Bank.branches_public_details[i]["address"],
-                "in_sock": socket.socket(socket.AF_INET, socket.SOCK_STREAM),
-                "in_conn": None
+                "in_conn": None,
+                "in_reader": None,
+                # updated only by the thread of the branch. See _dump_stats.
+                "stats": new_stats()
             })
 
-            port_in = self.inspctr_confs['port_base_in'] + self.branches[-1]["id"]
-            self.branches[-1]["in_sock"].bind((self.address, port_in))
-            self.branches[-1]["in_sock"].listen(1)
+    def accept_branches(self):
+        """
+        Accepts the connections of all branches.
+        :return: None
+        """
+        for _ in range(self.n_branches):
+            conn, _ = self.listener.accept()
+            reader = FrameReader(conn)
+
+            hello = reader.next_message()
+            branch = self.branches[self._id_to_index(hello["id"])]
+            branch["in_conn"], branch["in_reader"] = conn, reader
 
     def get_messages(self, bid):
 
         bid = self._id_to_index(bid)
 
-        self.branches[bid]["in_conn"], self.branches[bid]["address"] \
-            = self.branches[bid]["in_sock"].accept()
-
+        stats = self.branches[bid]["stats"] if self.stats_file is not None else None
+
+        for message in self.branches[bid]["in_reader"]:
+            self._handle_message(message, stats)
+
+    def ingest(self):
+        """
+        Reads the messages of all branches on the calling thread, instead of a thread per branch.
+        Every connection with data is read once per round, so a branch which sends a lot
+        does not hold up the others.
+        :return: None, once every branch has closed its connection.
+        """
+        selector = selectors.DefaultSelector()
+
+        for branch in self.branches:
+            stats = branch["stats"] if self.stats_file is not None else None
+
+            # the messages which arrived with the hello
+            for message in branch["in_reader"].messages():
+                self._handle_message(message, stats)
+
+            branch["in_conn"].setblocking(False)
+            selector.register(branch["in_conn"], selectors.EVENT_READ, (branch["in_reader"], stats))
+
+        n_open = len(self.branches)
+        while n_open > 0:
+            for key, _ in selector.select():
+                reader, stats = key.data
+
+                try:
+                    n_bytes = reader.fill()
+                except BlockingIOError:
+                    continue
+                except ConnectionError:
+                    n_bytes = 0
+
+                if n_bytes == 0:
+                    selector.unregister(key.fileobj)
+                    n_open -= 1
+                    continue
+
+                for message in reader.messages():
+                    self._handle_message(message, stats)
+
+        selector.close()
+
+    def _handle_message(self, message, stats):
+        """
+        :param message: a message of a branch.
+        :param stats: statistics of the branch, or None. See _dump_stats.
+        :return: None
+        """
+        # print("message:", message)
+
+        if message["subject"] in ("sends", "receives"):
+            self.events_received.inc(len(message["seqs"]))
+
+            if self.shards is not None:
+                self.shards.route(message)
+                return
+
+            start = perf_counter_ns()
+            matched = self.matcher.match(message)
+            lookup_ns = perf_counter_ns() - start
+
+            self.match_duration.observe(lookup_ns / 1e9)
+            self.transfers_matched.inc(len(matched))
+
+            if stats is not None:
+                record_transfers(stats, message, matched, lookup_ns, self.max_latency_samples)
+
+            log_transfers(self, matched)
+
+        elif message["subject"] == "global_snapshot":
+            self._check_global_snapshot(message)
+
+    def _receive_shard_report(self, report):
+        """
+        Adds the matches of a worker to the metrics. See sharding.MatchWorker._report.
+        :param report: the report.
+        :return: None
+        """
+        self.transfers_matched.inc(report["matched"])
+        for seconds in report["match_seconds"]:
+            self.match_duration.observe(seconds)
+
+    def _check_global_snapshot(self, message):
+        """
+        Assembles the channel states of a global snapshot into an N x N matrix (see GlobalState),
+        checks that no money was created or lost, and logs the snapshot.
+        :param message: global_snapshot message. See Bank._create_global_snapshot.
+        :return: None
+        """
         time_format = "%Y-%m-%d:%H:%M:%S"
-        c_sign = self.bank_confs['currency']['symbol']
-        c_unit = self.bank_confs['currency']['unit']
-        s_place = self.bank_confs['currency']['placement']
-        sign_before = f'{c_sign if s_place == "before" else ""}'
-        sign_after = f'{c_sign if s_place == "after" else ""}'
-        merged_unit_sign_after = c_unit + ' ' + sign_after
+        sign_before = self.sign_before
+        merged_unit_sign_after = self.merged_unit_sign_after
+
+        state = GlobalState(message, [branch["id"] for branch in self.branches])
+        total_balance = state.total
+        inflow = state.inflow
+        outflow = state.outflow
+
+        with self.lock:
+            self.n_global_snapshots += 1
+            number = self.n_global_snapshots
+
+            self.global_snapshots.inc()
+            self.snapshot_duration.observe(
+                (message["preparation_time"] - message["request_time"]).total_seconds())
+            if total_balance != self.expected_total:
+                self.inconsistent_snapshots.inc()
+
+            # stored in the order of their numbers
+            if self.snapshot_store is not None:
+                self.snapshot_store.append(
+                    state, message["initiator"], message["seq"],
+                    request_time=int(message["request_time"].timestamp() * 1e9),
+                    preparation_time=int(message["preparation_time"].timestamp() * 1e9),
+                    time=time_ns())
+
+            if self.stats_file is not None:
+                self.snapshot_stats.append({
+                    # when it was checked
+                    "time": time(),
+                    "initiator": message["initiator"],
+                    "seq": message["seq"],
+                    "n_branches": len(message["local_snapshots"]),
+                    "latency": (message["preparation_time"]
+                                - message["request_time"]).total_seconds(),
+                    "in_flight": state.in_flight,
+                    "conserved": total_balance == self.expected_total
+                })
+
+        log_message = (
+            '\n=============================================='
+            '=============================\n'
+            f'Global Snapshot #{number}'
+            f' (Initiator: Branch {message["initiator"]}, Seq: {message["seq"]})'
+            f'\tRequest Time:'
+            f'{message["request_time"].strftime(time_format)}'
+            f'\tPreparation Time:'
+            f'{message["preparation_time"].strftime(time_format)}')
+
+        for i, bid in enumerate(state.ids):
+            log_message += (
+                f'\nBranch {bid:>2}: Balance:'
+                f'{sign_before}'
+                f'{state.balances[i]}'
+                f'{merged_unit_sign_after:<8}'
+                f'- In Channels: '
+                f'{sign_before}'
+                f'{inflow[i]}'
+                f'{merged_unit_sign_after:<6}'
+                f'- Out Channels: '
+                f'{sign_before}'
+                f'{outflow[i]}'
+                f'{merged_unit_sign_after:<6}')
+
+        log_message += (
+            f'\nTotal Balance: '
+            f'{sign_before}'
+            f'{total_balance}'
+            f'{merged_unit_sign_after:<9}')
+
+        hot_channels = state.hot_channels(self.n_hot_channels)
+        if hot_channels:
+            log_message += '\nHot Channels: ' + ', '.join(
+                f'{sender} -> {receiver}: {sign_before}{amount}{merged_unit_sign_after.rstrip()}'
+                for sender, receiver, amount in hot_channels)
+
+        if total_balance != self.expected_total:
+            log_message += (f'\nNOT CONSERVED: the total balance should be '
+                            f'{sign_before}{self.expected_total}{merged_unit_sign_after}')
+
+        log_message += ('\n============================================='
+            '==============================\n')
+
+        self._log(log_message, in_file=True,
+                  level="info" if total_balance == self.expected_total else "warning")
+
+        cut = int((message["request_time"].timestamp() - self.pending_grace) * 1e9)
+        horizon = int(message["preparation_time"].timestamp() * 1e9)
+        if self.shards is not None:
+            self.shards.collect(cut, horizon)
+        else:
+            self.matcher.collect(cut, horizon)
+
+    def _dump_stats(self, interval: float = 1.0):
+        """
+        Writes the statistics of the run to `stats_file` every `interval` seconds.
+        The file is replaced atomically, so it can be read at any time.
+        """
+        path = Constants.dir_logs / self.stats_file
+        tmp_path = path.with_suffix(".tmp")
 
         while True:
-            pickled_data = self.branches[bid]["in_conn"].recv(4096)
-            message = pickle.loads(pickled_data)
-
-            # print("message:", message)
-
-            if message["subject"] == "send":
-                self.received_messages.append(message)
-
-                crspnd_msg = self.find_transfer_message(
-                    message,
-                    send_msg=True,
-                    remove=True)
-
-                if crspnd_msg:
-                    crspnd_msg["send_time"] = message["send_time"]
-
-            elif message["subject"] == "receive":
-                self.sent_messages.append(message)
-
-                crspnd_msg = self.find_transfer_message(
-                    message,
-                    send_msg=False,
-                    remove=True)
-
-                if crspnd_msg:
-                    crspnd_msg["receive_time"] = message["receive_time"]
-
-            elif message["subject"] == "global_snapshot":
-
-                self.n_global_snapshots += 1
-                total_balance = 0
-                log_message = (
-                    '\n=============================================='
-                    '=============================\n'
-                    f'Global Snapshot #{self.n_global_snapshots}'
-                    f'\tRequest Time:'
-                    f'{message["request_time"].strftime(time_format)}'
-                    f'\tPreparation Time:'
-                    f'{message["preparation_time"].strftime(time_format)}')
-
-                for snapshot in message["local_snapshots"]:
-                    log_message += (
-                        f'\nBranch {snapshot["id"]:>2}: Balance:'
-                        f'{sign_before}'
-                        f'{snapshot["balance"]}'
-                        # f'{c_unit:<9} '
-                        # f'{sign_after} '
-                        f'{merged_unit_sign_after:<8}'
-                        f'- In Channels: '
-                        f'{sign_before}'
-                        f'{snapshot["in_channels"]}'
-                        # f'{c_unit:<9} '
-                        # f'{sign_after}')
-                        f'{merged_unit_sign_after:<6}')
-
-                    total_balance += snapshot["balance"] + snapshot["in_channels"]
-
-                log_message += (
-                    f'\nTotal Balance: '
-                    f'{sign_before}'
-                    f'{total_balance}'
-                    # f'{c_unit:<9} '
-                    # f'{sign_after}')
-                    f'{merged_unit_sign_after:<9}')
-
-                log_message += ('\n============================================='
-                    '==============================\n')
-
-                self._log(log_message, in_file=True)
-
-            if crspnd_msg:
-                time_format = "%H:%M:%S"
-                log_message = (
-                    f'sender: {crspnd_msg["sender_id"]:>2} - '
-                    f'send_time: '
-                    f'{crspnd_msg["send_time"].strftime(time_format)}'
-                    f' - amount:'
-                    f'{sign_before}'
-                    f'{crspnd_msg["amount"]}'
-                    # f'{c_unit:<9} '
-                    # f'{sign_after}'
-                    f'{merged_unit_sign_after:<4}'
-                    f' - receiver:{crspnd_msg["receiver_id"]:>2}'
-                    f' - receive_time: '
-                    f'{crspnd_msg["receive_time"].strftime(time_format)}')
-
-                self._log(log_message, in_file=True)
-                crspnd_msg = None
-
-    def find_transfer_message(self, message, send_msg: bool=False,remove=True):
-
-        self.lock.acquire()
-
-        corresponding_message = False
-        query_list = self.sent_messages if send_msg else self.received_messages
-
-        for i, prev_message in enumerate(query_list):
-
-            if prev_message["amount"] == message["amount"] and \
-                prev_message["sender_id"] == message["sender_id"] and \
-                prev_message["receiver_id"] == message["receiver_id"]:
-
-                if remove:
-                    corresponding_message = query_list.pop(i)
-                else:
-                    corresponding_message = query_list[i]
-
-                self.lock.release()
-                return corresponding_message
-
-        self.lock.release()
-        return corresponding_message
+            stats = [branch["stats"] for branch in self.branches]
+            if self.shards is not None:
+                stats += self.shards.stats()
+
+            with self.lock:
+                snapshots = list(self.snapshot_stats)
+
+            pending = self._count_pending()
+
+            with open(tmp_path, "w") as file:
+                json.dump({
+                    "time": time(),
+                    "matched": sum(s["matched"] for s in stats),
+                    "lookups": sum(s["lookups"] for s in stats),
+                    "lookup_ns": sum(s["lookup_ns"] for s in stats),
+                    "pending": pending,
+                    "latencies": [latency for s in stats for latency in s["latencies"]],
+                    "snapshots": snapshots
+                }, file)
+            os.replace(tmp_path, path)
+
+            sleep(interval)
+
+    def _init_metrics(self):
+        """
+        Creates the metrics of the inspector. See metrics.py.
+        :return: None
+        """
+        self.events_received = metrics.counter(
+            "inspector_events_total", "Send and receive events reported by the branches.")
+        self.transfers_matched = metrics.counter(
+            "inspector_transfers_matched_total", "Transfers whose send and receive events were matched.")
+        self.match_duration = metrics.histogram(
+            "inspector_match_seconds", "Time spent matching a batch of events.")
+        self.global_snapshots = metrics.counter(
+            "inspector_global_snapshots_total", "Global snapshots checked.")
+        self.inconsistent_snapshots = metrics.counter(
+            "inspector_inconsistent_snapshots_total", "Global snapshots whose money did not add up.")
+        self.snapshot_duration = metrics.histogram(
+            "inspector_snapshot_seconds", "Time from the initiation of a snapshot to its global snapshot.")
+
+        metrics.gauge("inspector_pending_events", "Events waiting for the event of the other side.",
+                      function=self._count_pending)
+        metrics.gauge("inspector_expired_events",
+                      "Unmatched events spilled because a global snapshot showed that their "
+                      "other side will not be reported.",
+                      function=lambda: self._count_spilled("n_expired"))
+        metrics.gauge("inspector_spilled_events",
+                      "Unmatched events spilled because there were more than pending.max_events.",
+                      function=lambda: self._count_spilled("n_spilled"))
+
+    def _count_pending(self) -> int:
+
+        if self.shards is not None:
+            return self.shards.count_pending()
+
+        return self.matcher.count_pending()
+
+    def _count_spilled(self, counter: str) -> int:
+        """
+        :param counter: n_expired or n_spilled. See TransferMatcher.
+        """
+        if self.shards is not None:
+            return self.shards.total(counter)
+
+        return getattr(self.matcher, counter)
 
     def run(self):
 
-        threads = []
-        for i in range(self.n_branches):
-            threads.append(Thread(target=self.get_messages, args=(i, )))
-            threads[-1].start()
-        for i in range(self.n_branches):
-            threads[i].join()
+        self._serve_metrics(0)
+
+        if self.stats_file is not None:
+            Thread(target=self._dump_stats, name="stats_th", daemon=True).start()
+
+        if self.shards is not None:
+            self.shards.start()
+
+        self.accept_branches()
+
+        try:
+            # shared memory connections cannot be selected
+            if self.inspctr_confs['ingest'] == 'selectors' and self.inspctr_confs['transport'] != 'shm':
+                self.ingest()
+            else:
+                threads = []
+                for i in range(self.n_branches):
+                    threads.append(Thread(target=self.get_messages, args=(self.branches[i]["id"], ),
+                                          name=f"inspect_from{self.branches[i]['id']}_th"))
+                    threads[-1].start()
+                for i in range(self.n_branches):
+                    threads[i].join()
+        finally:
+            if self.shards is not None:
+                self.shards.stop()
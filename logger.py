@@ -0,0 +1,174 @@
+import atexit
+import random
+import sys
+from collections import deque
+from datetime import datetime
+from threading import Thread, Event, Lock
+from time import time
+
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+
+class LogWriter:
+    """
+    Writes the log records of the process on a background thread.
+    Logging a record only appends it to a bounded ring buffer. The writer thread
+    formats the records and writes them in batches to stdout and to the log files,
+    which are kept open. When the buffer is full, the oldest records are dropped
+    and counted.
+    """
+
+    def __init__(self):
+
+        self.level = LEVELS["debug"]
+        self.sample_rate = 1.0
+        self.buffered = True
+        self.flush_interval = 0.2
+        self.records = deque(maxlen=65536)
+
+        self.n_dropped = 0
+        self.n_reported_drops = 0
+        self.files = {}
+        self.wake = Event()
+        self.flush_lock = Lock()
+        self.writer = None
+
+        # the timestamp prefix is only formatted once per second
+        self._second = None
+        self._prefix = ""
+
+        atexit.register(self.flush)
+
+    def configure(self, level: str = "debug", sample_rate: float = 1.0, buffered: bool = True,
+                  buffer_size: int = 65536, flush_interval: float = 0.2):
+        """
+        Applies the `logging` section of the config file.
+        :param level: records below this level are ignored. See LEVELS.
+        :param sample_rate: fraction of the debug records which are kept.
+        :param buffered: write the records on the background thread.
+            Otherwise they are written before _log returns.
+        :param buffer_size: maximum number of records waiting to be written.
+        :param flush_interval: seconds between two writes of the background thread.
+        :return: None
+        """
+        self.level = LEVELS[level]
+        self.sample_rate = sample_rate
+        self.buffered = buffered
+        self.flush_interval = flush_interval
+
+        if buffer_size != self.records.maxlen:
+            self.flush()
+            self.records = deque(maxlen=buffer_size)
+
+    def log(self, message: str, args: tuple, stdio: bool, path, file_mode: str, level: str):
+        """
+        Queues a record.
+        :param message: the message, or a str.format template when args are given.
+        :param args: arguments of the template. They are formatted by the writer thread.
+        :param stdio: print the record.
+        :param path: log file of the record, or None.
+        :param file_mode: "w" truncates the log file before writing the record.
+        :param level: level of the record.
+        :return: None
+        """
+        if LEVELS[level] < self.level:
+            return
+
+        if level == "debug" and self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+
+        record = (time(), message, args, stdio, path, file_mode)
+
+        if not self.buffered:
+            with self.flush_lock:
+                self._write([record])
+            return
+
+        if self.writer is None:
+            self.writer = Thread(target=self._run, name="log_writer_th", daemon=True)
+            self.writer.start()
+
+        records = self.records
+        if len(records) >= records.maxlen:
+            self.n_dropped += 1
+        records.append(record)
+
+        # do not wait for the interval when the buffer is getting full
+        if len(records) > records.maxlen // 2:
+            self.wake.set()
+
+    def flush(self):
+        """
+        Writes every queued record.
+        :return: None
+        """
+        with self.flush_lock:
+            records = []
+            try:
+                while True:
+                    records.append(self.records.popleft())
+            except IndexError:
+                pass
+
+            self._write(records)
+
+    def _run(self):
+
+        while True:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+    def _write(self, records):
+
+        printed = []
+        # path -> [truncate the file, lines]
+        written = {}
+
+        if self.n_dropped > self.n_reported_drops:
+            printed.append(f"{self._timestamp(time())}{self.n_dropped - self.n_reported_drops} "
+                           f"log records were dropped because the log buffer was full.")
+            self.n_reported_drops = self.n_dropped
+
+        for created, message, args, stdio, path, file_mode in records:
+            if args:
+                message = message.format(*args)
+
+            line = self._timestamp(created) + message
+
+            if stdio:
+                printed.append(line)
+
+            if path is not None:
+                if file_mode == "w":
+                    written[path] = [True, []]
+                written.setdefault(path, [False, []])[1].append(line)
+
+        if printed:
+            sys.stdout.write("\n".join(printed) + "\n")
+            sys.stdout.flush()
+
+        for path, (truncate, lines) in written.items():
+            file = self.files.get(path)
+
+            if truncate or file is None:
+                if file is not None:
+                    file.close()
+                file = self.files[path] = open(path, mode="w" if truncate else "a")
+
+            file.write("\n".join(lines) + "\n")
+            file.flush()
+
+    def _timestamp(self, created: float) -> str:
+
+        second = int(created)
+        if second != self._second:
+            self._second = second
+            self._prefix = datetime.fromtimestamp(second).strftime("%Y-%m-%d:%H:%M:%S ")
+
+        return self._prefix
+
+
+# shared by every Bank or Inspector of the process
+log_writer = LogWriter()
@@ -1,9 +1,14 @@
 import argparse
 import shutil
+import signal
+from pathlib import Path
 
-from bank import Bank
+from bank import Bank, send_command
+from async_bank import AsyncBank
 from inspector import Inspector
-from commons import Constants
+from cluster import Cluster
+from commons import Constants, load_config
+from profiling import profiler, MODES
 
 if __name__ == '__main__':
 
@@ -14,11 +19,32 @@ if __name__ == '__main__':
                     help="Use this option to run an instance of Bank (a branch).")
     ap.add_argument("-i", "--inspector", required=False, action='store_true',
                     help="Use this option to run the inspector")
+    ap.add_argument("-e", "--engine", required=False, default="threads",
+                    choices=["threads", "asyncio"],
+                    help="Runtime of the branch: a few threads per peer (threads) "
+                         "or a single event loop (asyncio).")
+    ap.add_argument("-s", "--snapshot", required=False, type=int, metavar="BRANCH_ID",
+                    help="Ask a running branch to initiate a snapshot.")
     ap.add_argument("-c", "--clear", required=False, action='store_true',
                     help="Clear the branches information file.")
+    ap.add_argument("--cluster", required=False, type=int, metavar="N",
+                    help="Run the inspector and N branches as processes of this machine, "
+                         "until Ctrl-C or until one of them exits.")
+    ap.add_argument("--keep-logs", required=False, action='store_true',
+                    help="With --cluster: keep logs/ when the cluster stops. bank/ is always removed.")
+    ap.add_argument("--config", required=False, default=None,
+                    help=f"Config file. Default: {Constants.config_file}")
+    ap.add_argument("--profile", required=False, choices=MODES,
+                    help="Profile the threads of the branch or the inspector (see profiling.py). "
+                         "Overrides profiling.mode of the config file.")
+    ap.add_argument("--profile-memory", required=False, action='store_true',
+                    help="Trace the memory allocations with tracemalloc.")
 
     args = ap.parse_args()
 
+    if args.config is not None:
+        Constants.config_file = Path(args.config)
+
     if args.clear:
         try:
             shutil.rmtree(Constants.dir_logs)
@@ -29,13 +55,60 @@ if __name__ == '__main__':
 
         exit(0)
 
+    if args.snapshot is not None:
+        control_port = load_config()['snapshot']['control_port']
+        print("snapshot:", send_command(args.snapshot, "snapshot", control_port))
+
+        exit(0)
+
+    if args.cluster is not None:
+        if args.cluster < 2:
+            ap.error("A cluster needs at least 2 branches.")
+
+        cluster = Cluster(args.cluster, args.engine)
+        keep_logs = args.keep_logs
+        try:
+            cluster.start()
+            print(f"The inspector and {args.cluster} branches are running. Press Ctrl-C to stop them.")
+            cluster.wait()
+        except KeyboardInterrupt:
+            pass
+        except RuntimeError as e:
+            print(f"{e} See the outputs in {Constants.dir_logs}/")
+            keep_logs = True
+        finally:
+            cluster.stop()
+            Cluster.teardown(keep_logs=keep_logs)
+
+        exit(0)
+
+    if args.bank or args.inspector:
+        profiling = load_config()['profiling']
+        if args.profile is not None:
+            profiling['mode'] = args.profile
+        if args.profile_memory:
+            profiling['memory'] = True
+
+        # before the threads are created, so that they are all profiled
+        try:
+            profiler.start(**profiling)
+        except (ValueError, RuntimeError) as e:
+            ap.error(str(e))
+        if profiler.enabled and hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda *_: profiler.dump())
+
     if args.bank and args.inspector:
         raise "You must only use one option."
     elif args.bank:
-        branch = Bank()
-        branch.run()
+        branch = AsyncBank() if args.engine == "asyncio" else Bank()
+        profiler.name = f"branch_{branch.id}"
+        try:
+            branch.run()
+        except KeyboardInterrupt:
+            branch.stop()
     elif args.inspector:
         inspector = Inspector()
+        profiler.name = "inspector"
         inspector.run()
     else:
         raise "Use one of the options (-b or -i)"
@@ -0,0 +1,305 @@
+"""
+Matching of the send and receive events which the branches report to the inspector.
+
+The events which wait for their other side are kept in memory, up to a budget. The ones which
+are collected (see TransferMatcher.collect) or which do not fit are written to a spill file:
+one record per event, of SPILL_FIELDS as 8 byte integers in the byte order of the machine.
+It can be read with `numpy.fromfile(path, dtype=numpy.int64).reshape(-1, len(SPILL_FIELDS))`.
+"""
+import random
+import threading
+from array import array
+from datetime import datetime
+from itertools import islice
+from math import ceil
+from time import time
+
+from logger import log_writer, LEVELS
+
+
+SPILL_FIELDS = ("reason", "side", "sender_id", "receiver_id", "seq", "amount", "time")
+# reasons of the spilled events
+EXPIRED, OVERFLOW = 0, 1
+# sides of the spilled events
+SEND, RECEIVE = 0, 1
+
+
+def channel_shard(sender_id: int, receiver_id: int, n_shards: int) -> int:
+    """
+    :return: the shard which matches the events of the channel. See sharding.py.
+    """
+    return hash((sender_id, receiver_id)) % n_shards
+
+
+class TransferMatcher:
+    """
+    Matches the send and receive events of the transfers. Events are matched per channel,
+    so the threads of unrelated channels never wait for each other. Unmatched events
+    are indexed by their sequence numbers, as (amount, time in ns), in the order they arrived.
+    """
+
+    # fraction of the budget which is freed when it is exceeded, so that events are not
+    # spilled for every batch
+    spill_fraction = 0.1
+
+    def __init__(self, branch_ids, shard: int = 0, n_shards: int = 1,
+                 max_events: int = None, spill_path=None):
+        """
+        :param branch_ids: ids of all branches.
+        :param shard: only the channels of this shard are matched. See channel_shard.
+        :param n_shards: number of shards.
+        :param max_events: maximum number of unmatched events kept in memory. None keeps them all.
+        :param spill_path: file of the spilled events, which is overwritten.
+            None only counts them.
+        """
+        # (sender_id, receiver_id) -> unmatched events of the channel
+        self.pending = {}
+
+        self.max_events = max_events
+        # events kept in memory. It is updated once per batch.
+        self.n_events = 0
+        self.n_expired = 0
+        self.n_spilled = 0
+        # events older than this time (in ns) have been collected
+        self.cut = 0
+        # (side, branch id) -> time (in ns) of the latest event matched from that stream of the
+        # branch, e.g. ("receive", 2) for the receives of branch 2. Every branch reports each side
+        # in the order the events happened. See collect.
+        self.watermarks = {}
+        # a thread is spilling the oldest events
+        self.spilling = False
+        # guards the counters and the spill file
+        self.lock = threading.Lock()
+        self.spill_file = open(spill_path, "wb") if spill_path is not None else None
+
+        for sender_id in branch_ids:
+            for receiver_id in branch_ids:
+                if sender_id != receiver_id and channel_shard(sender_id, receiver_id, n_shards) == shard:
+                    self.pending[(sender_id, receiver_id)] = {
+                        "lock": threading.Lock(),
+                        "send": {},
+                        "receive": {}
+                    }
+
+    def match(self, message) -> list:
+        """
+        Matches a batch of send or receive events with the events of the other side.
+        The unmatched events are kept until their other side arrives.
+        :param message: "sends" or "receives" batch of a branch. See Bank._report.
+        :return: list of the matched transfers:
+            (sender_id, receiver_id, amount, seq, send time in ns, receive time in ns)
+        """
+        if message["subject"] == "sends":
+            side, other_side = "send", "receive"
+            branch_id, peer_ids = message["sender_id"], message["receiver_ids"]
+            times = message["send_times"]
+        else:
+            side, other_side = "receive", "send"
+            branch_id, peer_ids = message["receiver_id"], message["sender_ids"]
+            times = message["receive_times"]
+
+        amounts, seqs = message["amounts"], message["seqs"]
+
+        # the events are grouped by channel, so each channel is locked once per batch
+        rows = {}
+        for i, peer_id in enumerate(peer_ids):
+            rows.setdefault(peer_id, []).append(i)
+
+        matched = []
+        n_stored = 0
+        for peer_id, channel_rows in rows.items():
+            channel = (branch_id, peer_id) if side == "send" else (peer_id, branch_id)
+            pending = self.pending[channel]
+
+            with pending["lock"]:
+                waiting, others = pending[side], pending[other_side]
+
+                for i in channel_rows:
+                    corresponding = others.pop(seqs[i], None)
+
+                    if corresponding is None:
+                        waiting[seqs[i]] = (amounts[i], times[i])
+                        n_stored += 1
+                    elif side == "send":
+                        matched.append((*channel, amounts[i], seqs[i], times[i], corresponding[1]))
+                    else:
+                        matched.append((*channel, amounts[i], seqs[i], corresponding[1], times[i]))
+
+        with self.lock:
+            if len(times):
+                watermark = (side, branch_id)
+                self.watermarks[watermark] = max(self.watermarks.get(watermark, 0), max(times))
+
+            self.n_events += n_stored - len(matched)
+            over_budget = (self.max_events is not None and self.n_events > self.max_events
+                           and not self.spilling)
+            if over_budget:
+                self.spilling = True
+
+        if over_budget:
+            self._spill_oldest()
+
+        return matched
+
+    def collect(self, cut: int, horizon: int):
+        """
+        Spills the unmatched events which happened before `cut`, once the other side of their
+        transfers has been read.
+        Every transfer which was sent before a global snapshot was initiated has been received
+        by the time the snapshot is complete, as channels are FIFO. So once the events until
+        then have been read from the branch which reports the other side (its watermark),
+        the events before the snapshot which are still unmatched never will be, e.g. because
+        a branch died before it reported the other side.
+        :param cut: time in ns since the epoch, usually the request time of a complete
+            global snapshot minus a grace period. Earlier cuts than the last one are ignored.
+        :param horizon: time in ns since the epoch by which the other sides have happened,
+            usually the preparation time of the global snapshot.
+        :return: None
+        """
+        with self.lock:
+            if cut <= self.cut:
+                return
+            self.cut = cut
+            watermarks = dict(self.watermarks)
+
+        spilled = array("q")
+        for channel, pending in list(self.pending.items()):
+            sender_id, receiver_id = channel
+
+            # an unmatched send waits for the receives of the receiver, and the other way around
+            sides = []
+            if watermarks.get(("receive", receiver_id), 0) >= horizon:
+                sides.append(("send", SEND))
+            if watermarks.get(("send", sender_id), 0) >= horizon:
+                sides.append(("receive", RECEIVE))
+            if not sides:
+                continue
+
+            with pending["lock"]:
+                for side, code in sides:
+                    waiting = pending[side]
+
+                    expired = []
+                    for seq, (amount, event_time) in waiting.items():
+                        # the events of a side of a channel arrive in the order they happened
+                        if event_time >= cut:
+                            break
+                        expired.append(seq)
+                        spilled.extend((EXPIRED, code, *channel, seq, amount, event_time))
+
+                    for seq in expired:
+                        del waiting[seq]
+
+        self._spill(spilled, EXPIRED)
+
+    def _spill_oldest(self):
+        """
+        Spills the oldest events of every channel, in proportion to its number of events,
+        until the number of events is back under the budget.
+        """
+        with self.lock:
+            fraction = 1 - (1 - self.spill_fraction) * self.max_events / self.n_events
+
+        spilled = array("q")
+        for channel, pending in list(self.pending.items()):
+            with pending["lock"]:
+                for side, code in (("send", SEND), ("receive", RECEIVE)):
+                    waiting = pending[side]
+
+                    oldest = list(islice(waiting.items(), ceil(len(waiting) * fraction)))
+                    for seq, (amount, event_time) in oldest:
+                        del waiting[seq]
+                        spilled.extend((OVERFLOW, code, *channel, seq, amount, event_time))
+
+        self._spill(spilled, OVERFLOW)
+        self.spilling = False
+
+    def _spill(self, spilled: array, reason: int):
+        """
+        Writes the spilled events and counts them.
+        :param spilled: the events, as consecutive records of SPILL_FIELDS.
+        :param reason: EXPIRED or OVERFLOW.
+        """
+        n_spilled = len(spilled) // len(SPILL_FIELDS)
+        if n_spilled == 0:
+            return
+
+        with self.lock:
+            self.n_events -= n_spilled
+            if reason == EXPIRED:
+                self.n_expired += n_spilled
+            else:
+                self.n_spilled += n_spilled
+
+            if self.spill_file is not None:
+                spilled.tofile(self.spill_file)
+                self.spill_file.flush()
+
+    def count_pending(self) -> int:
+        """
+        :return: number of events waiting for the event of the other side.
+        """
+        pending = 0
+        for channel in list(self.pending.values()):
+            pending += len(channel["send"]) + len(channel["receive"])
+
+        return pending
+
+
+def new_stats() -> dict:
+    """
+    :return: empty statistics of the matched transfers. See record_transfers.
+        latencies holds (time of the match, latency) samples, in seconds.
+    """
+    return {"matched": 0, "lookups": 0, "lookup_ns": 0, "n_latencies": 0, "latencies": []}
+
+
+def record_transfers(stats: dict, message, matched: list, lookup_ns: int, max_samples: int):
+    """
+    Updates the statistics after a batch of events has been matched.
+    :param stats: the statistics. See new_stats.
+    :param message: the batch of events.
+    :param matched: the matched transfers. See TransferMatcher.match.
+    :param lookup_ns: time spent in TransferMatcher.match.
+    :param max_samples: maximum number of latencies which are kept.
+    :return: None
+    """
+    stats["lookups"] += len(message["seqs"])
+    stats["lookup_ns"] += lookup_ns
+    stats["matched"] += len(matched)
+
+    # latency from the send to the match. A fixed size sample of them is kept, with the time
+    # of the match, so a window of the run can be summarized. See benchmark.py.
+    now = time()
+    for transfer in matched:
+        latency = (now, now - transfer[4] / 1e9)
+        stats["n_latencies"] += 1
+        if len(stats["latencies"]) < max_samples:
+            stats["latencies"].append(latency)
+        else:
+            i = random.randrange(stats["n_latencies"])
+            if i < max_samples:
+                stats["latencies"][i] = latency
+
+
+def log_transfers(owner, matched: list):
+    """
+    Logs the matched transfers at debug level, in the log file of `owner`.
+    :param owner: the inspector or one of its workers (BaseClass).
+    :param matched: the matched transfers. See TransferMatcher.match.
+    :return: None
+    """
+    if not matched or log_writer.level > LEVELS["debug"]:
+        return
+
+    sign_before = owner.sign_before
+    merged_unit_sign_after = owner.merged_unit_sign_after
+
+    for sender_id, receiver_id, amount, _, send_ns, receive_ns in matched:
+        owner._log(
+            'sender: {:>2} - send_time: {:%H:%M:%S} - amount:{}{}{:<4}'
+            ' - receiver:{:>2} - receive_time: {:%H:%M:%S}',
+            sender_id, datetime.fromtimestamp(send_ns / 1e9),
+            sign_before, amount, merged_unit_sign_after,
+            receiver_id, datetime.fromtimestamp(receive_ns / 1e9),
+            in_file=True, level="debug")
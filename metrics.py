@@ -0,0 +1,242 @@
+"""
+Metrics of the process (counters, gauges and histograms), served over HTTP in the
+Prometheus text format, e.g. `curl localhost:13001/metrics`.
+
+Updating a metric only takes a few attribute updates. Gauges which are expensive to
+keep up to date (e.g. queue sizes) are functions which are only called when the
+metrics are read.
+"""
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import perf_counter
+
+
+# upper bounds of the buckets of the histograms, in seconds
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+
+def _format_labels(labels: dict) -> str:
+
+    if not labels:
+        return ""
+
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+class Counter:
+    """
+    A value which only increases.
+    """
+
+    def __init__(self):
+        self.value = 0
+        self.lock = Lock()
+
+    def inc(self, amount: int = 1):
+
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name: str, labels: dict):
+        yield name, labels, self.value
+
+
+class Gauge:
+    """
+    A value which can go up and down. It is either set, or computed by `function`
+    when the metrics are read.
+    """
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name: str, labels: dict):
+        yield name, labels, self.value if self.function is None else self.function()
+
+
+class Histogram:
+    """
+    Distribution of observed values (e.g. latencies) in cumulative buckets.
+    """
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        # the last count is for the values above the last bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.lock = Lock()
+
+    def observe(self, value: float):
+
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def samples(self, name: str, labels: dict):
+
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf", ), counts):
+            cumulative += count
+            yield f"{name}_bucket", dict(labels, le=bound), cumulative
+        yield f"{name}_sum", labels, total
+        yield f"{name}_count", labels, cumulative
+
+
+class TimedLock:
+    """
+    A Lock which records in a histogram how long its acquisitions waited.
+    Acquisitions which do not wait are only counted, in n_uncontended.
+    """
+
+    def __init__(self, histogram: Histogram):
+        self.lock = Lock()
+        self.histogram = histogram
+        # only updated while the lock is held
+        self.n_uncontended = 0
+
+    def __enter__(self):
+
+        if not self.lock.acquire(blocking=False):
+            start = perf_counter()
+            self.lock.acquire()
+            self.histogram.observe(perf_counter() - start)
+        else:
+            self.n_uncontended += 1
+
+        return self
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        return self.lock.acquire(blocking, timeout)
+
+    def release(self):
+        self.lock.release()
+
+
+class Metrics:
+    """
+    The metrics of the process, grouped by name. A metric can have several instances
+    which are told apart by their labels, e.g. the queue of each connection.
+    """
+
+    def __init__(self):
+
+        # name -> [type, help, {labels: metric}]
+        self.families = {}
+        self.lock = Lock()
+        self.server = None
+
+    def _get(self, kind: str, name: str, description: str, labels: dict, make):
+
+        key = tuple(sorted((labels or {}).items()))
+
+        with self.lock:
+            family = self.families.setdefault(name, [kind, description, {}])
+            if key not in family[2]:
+                family[2][key] = make()
+
+            return family[2][key]
+
+    def counter(self, name: str, description: str, labels: dict = None) -> Counter:
+        """
+        :param name: name of the metric, e.g. "bank_transfers_sent_total".
+        :param description: help text of the metric.
+        :param labels: e.g. {"peer": 2}
+        :return: the counter with these labels. It is created on the first call.
+        """
+        return self._get("counter", name, description, labels, Counter)
+
+    def gauge(self, name: str, description: str, labels: dict = None, function=None) -> Gauge:
+        """
+        :param function: computes the value when the metrics are read. See Gauge.
+        :return: the gauge with these labels. See counter.
+        """
+        gauge = self._get("gauge", name, description, labels, Gauge)
+        if function is not None:
+            gauge.function = function
+
+        return gauge
+
+    def histogram(self, name: str, description: str, labels: dict = None,
+                  buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        """
+        :param buckets: upper bounds of the buckets.
+        :return: the histogram with these labels. See counter.
+        """
+        return self._get("histogram", name, description, labels, lambda: Histogram(buckets))
+
+    def timed_lock(self, name: str, description: str) -> TimedLock:
+        """
+        :return: a new lock whose waits are recorded in the histogram `name`.
+            Its acquisitions which did not wait are counted in the gauge `name`_uncontended.
+        """
+        lock = TimedLock(self.histogram(name, description))
+        self.gauge(f"{name}_uncontended", "Acquisitions which did not wait, of the lock of "
+                                          f"{name}.", function=lambda: lock.n_uncontended)
+
+        return lock
+
+    def exposition(self) -> str:
+        """
+        :return: the metrics in the Prometheus text format.
+        """
+        with self.lock:
+            families = [(name, kind, description, list(metrics.items()))
+                        for name, (kind, description, metrics) in self.families.items()]
+
+        lines = []
+        for name, kind, description, metrics in families:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+
+            for key, metric in metrics:
+                for sample, labels, value in metric.samples(name, dict(key)):
+                    lines.append(f"{sample}{_format_labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, address: str = 'localhost'):
+        """
+        Serves the metrics on http://address:port/metrics, on a background thread.
+        :return: None
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = registry.exposition().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # requests are not logged
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), Handler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, name="metrics_th", daemon=True).start()
+
+
+# shared by every Bank or Inspector of the process
+metrics = Metrics()
@@ -0,0 +1,120 @@
+from queue import Queue, Empty
+from threading import Thread, Condition
+from time import perf_counter
+
+from codec import pack_message
+from commons import Constants
+from metrics import metrics
+
+
+class Outbox:
+    """
+    Outgoing side of one connection.
+    Messages are put in a queue and a dedicated writer thread sends them in the same order,
+    so a slow connection only delays its own messages. Frames which are already queued
+    when the writer wakes up are sent with a single sendall.
+    Queuing never blocks, so it can be done with a lock held. The senders wait for room
+    with drain, like with an asyncio.StreamWriter.
+    """
+
+    def __init__(self, conn, name: str, max_queued: int = 10_000, max_batch: int = 256,
+                 labels: dict = None):
+        """
+        :param conn: connected socket.
+        :param name: name of the writer thread.
+        :param max_queued: drain waits while this many frames are waiting.
+        :param max_batch: maximum number of frames sent with one sendall.
+        :param labels: labels of the metrics of the connection, e.g. {"to": 2}
+        """
+        self.conn = conn
+        # (time it was queued, frame), or None to stop the writer
+        self.queue = Queue()
+        self.max_queued = max_queued
+        self.max_batch = max_batch
+        self.closed = False
+        # notified when frames have been written, or when the connection is broken
+        self.written = Condition()
+
+        self.send_delay = metrics.histogram(
+            "outbox_send_seconds", "Time from queuing a message to writing it.", labels)
+        metrics.gauge("outbox_queued_messages", "Messages waiting to be written.", labels,
+                      function=self.queue.qsize)
+
+        self.writer = Thread(target=self._write, name=name, daemon=True)
+        self.writer.start()
+
+    def send(self, message) -> bool:
+        """
+        Queues a message to be sent.
+        :param message: it can be everything
+        :return: False if the connection is closed or broken, True otherwise.
+        """
+        if self.closed:
+            return False
+
+        self.queue.put((perf_counter(), pack_message(message)))
+
+        return True
+
+    def drain(self, timeout: float = None) -> bool:
+        """
+        Waits until fewer than max_queued frames are waiting, or the connection is closed.
+        Must not be called with a lock held.
+        :param timeout: maximum seconds to wait. None waits until there is room.
+        :return: False if it timed out, True otherwise.
+        """
+        with self.written:
+            return self.written.wait_for(
+                lambda: self.closed or self.queue.qsize() < self.max_queued, timeout)
+
+    def _write(self):
+
+        while True:
+            frames = [self.queue.get()]
+
+            while frames[-1] is not None and len(frames) < self.max_batch:
+                try:
+                    frames.append(self.queue.get_nowait())
+                except Empty:
+                    break
+
+            closing = frames[-1] is None
+            if closing:
+                frames.pop()
+
+            try:
+                self.conn.sendall(b"".join(frame for _, frame in frames))
+            except OSError:
+                self.closed = True
+                with self.written:
+                    self.written.notify_all()
+
+                # the queued frames will never be sent
+                while True:
+                    try:
+                        self.queue.get_nowait()
+                    except Empty:
+                        return
+
+            with self.written:
+                self.written.notify_all()
+
+            sent = perf_counter()
+            for queued, _ in frames:
+                self.send_delay.observe(sent - queued)
+
+            if closing:
+                return
+
+    def shutdown(self, how):
+        """
+        Sends the queued messages and shuts the connection down.
+        :param how: see socket.shutdown
+        :return: None
+        """
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.writer.join(Constants.wait_timeout)
+
+        self.conn.shutdown(how)
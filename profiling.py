@@ -0,0 +1,178 @@
+"""
+Opt-in profiling of every thread of the process (see the `profiling` section of config.yml
+and main.py --profile).
+
+Modes:
+    cprofile: a cProfile profiler per thread. Every thread gets a <name>.<thread>.<id>.prof file,
+        which can be read with pstats, snakeviz or flameprof. Python 3.11 or earlier only.
+    sampling: the stacks of all threads are sampled every `interval` seconds, with little
+        overhead. Every thread gets a <name>.<thread>.<id>.folded file, in the folded stack format
+        of flamegraph.pl and speedscope.
+The id is the native id of the thread, since threads may have the same name
+(e.g. control_client_th).
+With `memory`, the allocations are traced with tracemalloc too, and <name>.tracemalloc.txt
+lists the lines which allocated the most memory (the full snapshot is in <name>.tracemalloc).
+
+The files are written in logs/profiles/ when the process exits, and on demand:
+on SIGUSR1, or with the "profile" command of the control port of a branch.
+"""
+import atexit
+import cProfile
+import marshal
+import os
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+
+from commons import Constants
+
+
+MODES = ("cprofile", "sampling")
+
+
+class Profiler:
+    """
+    Profiles the threads of the process.
+    """
+
+    def __init__(self):
+
+        self.mode = None
+        self.interval = 0.005
+        self.memory = False
+        # prefix of the files, e.g. "branch_2"
+        self.name = f"process_{os.getpid()}"
+        self.directory = Constants.dir_logs / "profiles"
+
+        # cprofile: (thread name, native id) -> its profiler
+        self.profiles = {}
+        # sampling: (thread name, native id, stack) -> number of samples
+        self.samples = Counter()
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode is not None or self.memory
+
+    def start(self, mode: str = None, interval: float = 0.005, memory: bool = False):
+        """
+        Starts profiling. Threads which are started after it are profiled too.
+        :param mode: cprofile, sampling or None (only the memory, if it is on).
+        :param interval: seconds between two samples of the sampling mode.
+        :param memory: trace the memory allocations with tracemalloc.
+        :return: None
+        """
+        if mode is not None and mode not in MODES:
+            raise ValueError(f"Unknown profiling mode: {mode}. Use one of {MODES}.")
+
+        # From Python 3.12, cProfile is built on sys.monitoring, which allows a single
+        # profiler per process: the threads cannot have their own.
+        if mode == "cprofile" and sys.version_info >= (3, 12):
+            raise RuntimeError("The cprofile mode needs a profiler per thread, which Python 3.12 "
+                               "and later do not allow. Use the sampling mode instead.")
+
+        self.mode = mode
+        self.interval = interval
+        self.memory = memory
+
+        if not self.enabled:
+            return
+
+        if memory:
+            # frames kept per allocation
+            tracemalloc.start(25)
+
+        if mode == "cprofile":
+            # installed in every new thread before its target runs
+            threading.setprofile(self._profile_thread)
+            self._profile_thread()
+        elif mode == "sampling":
+            threading.Thread(target=self._sample, name="profiler_th", daemon=True).start()
+
+        atexit.register(self.dump)
+
+    def _profile_thread(self, *args):
+        """
+        Starts a cProfile profiler in the calling thread.
+        """
+        # this hook is only needed once per thread
+        sys.setprofile(None)
+
+        thread = threading.current_thread()
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles[(thread.name, thread.native_id)] = profile
+
+        profile.enable()
+
+    def _sample(self):
+
+        own = threading.get_ident()
+
+        while not self.stopped.wait(self.interval):
+            threads = {thread.ident: (thread.name, thread.native_id)
+                       for thread in threading.enumerate()}
+
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.reverse()
+
+                with self.lock:
+                    self.samples[(*threads.get(ident, (str(ident), ident)), ";".join(stack))] += 1
+
+    def dump(self) -> str:
+        """
+        Writes the profiles collected so far. Profiling goes on.
+        :return: the directory of the files, or a message if profiling is off.
+        """
+        if not self.enabled:
+            return "profiling is off"
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        prefix = self.directory / self.name
+
+        if self.mode == "cprofile":
+            with self.lock:
+                profiles = list(self.profiles.items())
+
+            for (thread_name, thread_id), profile in profiles:
+                # unlike dump_stats, it does not stop the profiler
+                profile.snapshot_stats()
+                with open(f"{prefix}.{thread_name}.{thread_id}.prof", "wb") as file:
+                    marshal.dump(profile.stats, file)
+
+        elif self.mode == "sampling":
+            # (thread name, native id) -> lines
+            folded = {}
+            with self.lock:
+                samples = list(self.samples.items())
+
+            for (thread_name, thread_id, stack), count in samples:
+                folded.setdefault((thread_name, thread_id), []).append(f"{stack} {count}")
+
+            for (thread_name, thread_id), lines in folded.items():
+                with open(f"{prefix}.{thread_name}.{thread_id}.folded", "w") as file:
+                    file.write("\n".join(lines) + "\n")
+
+        if self.memory:
+            snapshot = tracemalloc.take_snapshot()
+            snapshot.dump(f"{prefix}.tracemalloc")
+
+            with open(f"{prefix}.tracemalloc.txt", "w") as file:
+                for stat in snapshot.statistics("lineno")[:50]:
+                    file.write(f"{stat}\n")
+
+        return str(self.directory)
+
+
+# shared by every Bank or Inspector of the process
+profiler = Profiler()
@@ -0,0 +1,152 @@
+import errno
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from select import select
+from time import sleep
+
+# Windows
+if os.name == 'nt':
+    import msvcrt
+# Posix (Linux, OS X)
+else:
+    import fcntl
+
+
+class Registry:
+    """
+    Membership of the branches, shared by the processes of one machine through a directory.
+    Members are kept in `bank.json`. A lock file serializes the registrations, so every
+    branch gets a distinct id, and the file is replaced atomically, so it is never read
+    while it is partially written.
+    Processes waiting for the members create a named pipe in `waiters/`. Every registration
+    writes a byte to all of them, so waiters sleep until the membership changes instead of
+    polling the file. On Windows, which has no named pipes, waiters poll the file.
+    """
+
+    def __init__(self, directory: Path, poll_interval: float = 1.0):
+        """
+        :param directory: directory of the registry. It is created if it does not exist.
+        :param poll_interval: seconds between two reads of the members while waiting,
+            in case a notification is missed.
+        """
+        self.file = directory / "bank.json"
+        self.lock_file = directory / "bank.lock"
+        self.waiters_dir = directory / "waiters"
+        self.poll_interval = poll_interval
+
+        self.waiters_dir.mkdir(parents=True, exist_ok=True)
+
+    def members(self) -> list:
+        """
+        :return: the public details of the registered branches, ordered by id.
+        """
+        try:
+            with open(self.file, "r") as f:
+                return json.load(f)["branch_details"]
+        except FileNotFoundError:
+            return []
+
+    def register(self, make_details) -> dict:
+        """
+        Registers a new branch and wakes up the waiting processes.
+        :param make_details: function that returns the public details of the branch
+            (e.g. its address), given its id.
+        :return: the registered details, including the id.
+        """
+        with self._locked():
+            members = self.members()
+
+            details = {"id": len(members)}
+            details.update(make_details(details["id"]))
+            members.append(details)
+
+            tmp_file = self.file.with_name(f"{self.file.name}.{os.getpid()}.tmp")
+            with open(tmp_file, "w") as f:
+                json.dump({"branch_details": members}, f)
+            os.replace(tmp_file, self.file)
+
+        self._notify()
+
+        return details
+
+    def wait(self, n_branches: int) -> list:
+        """
+        Blocks until at least `n_branches` branches are registered.
+        :param n_branches: number of branches to wait for.
+        :return: the public details of the registered branches.
+        """
+        if os.name == 'nt':
+            fifo = None
+        else:
+            path = self.waiters_dir / f"{os.getpid()}.{id(self)}.fifo"
+            os.mkfifo(path)
+            # Opened before reading the members, so no registration after it is missed.
+            # It is also opened for writing, so it never reads as closed (end of file)
+            # once the writer of a notification has closed it.
+            fifo = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+
+        try:
+            while True:
+                members = self.members()
+                if len(members) >= n_branches:
+                    return members
+
+                if fifo is None:
+                    sleep(self.poll_interval)
+                    continue
+
+                readable, _, _ = select([fifo], [], [], self.poll_interval)
+                if readable:
+                    os.read(fifo, 4096)
+        finally:
+            if fifo is not None:
+                os.close(fifo)
+                os.unlink(path)
+
+    def _notify(self):
+
+        if os.name == 'nt':
+            return
+
+        for path in self.waiters_dir.glob("*.fifo"):
+            try:
+                fifo = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                # ENXIO: the waiter has closed it and is about to remove it
+                if e.errno in (errno.ENXIO, errno.ENOENT):
+                    continue
+                raise
+
+            try:
+                os.write(fifo, b"\0")
+            except BlockingIOError:
+                # the pipe is full of notifications which have not been read yet
+                pass
+            except BrokenPipeError:
+                # the waiter has just closed it
+                pass
+            finally:
+                os.close(fifo)
+
+    @contextmanager
+    def _locked(self):
+        """
+        Holds the lock of the registry, which is shared by all processes.
+        """
+        with open(self.lock_file, "a+b") as f:
+            if os.name == 'nt':
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            else:
+                fcntl.flock(f, fcntl.LOCK_EX)
+
+            try:
+                yield
+            finally:
+                if os.name == 'nt':
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+                else:
+                    fcntl.flock(f, fcntl.LOCK_UN)
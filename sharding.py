@@ -0,0 +1,268 @@
+"""
+Matching of the transfers in worker processes (inspector.workers in config.yml).
+
+The channels are split into shards (see matching.channel_shard) and every worker process
+owns one of them. The threads of the inspector only decode the batches of events and split
+them by shard. The workers match the events of their channels, log the matched transfers in
+their own log file (e.g. logs/inspector_worker0.log) and report their statistics to the
+inspector, which merges them with the global snapshots it checks itself.
+"""
+import multiprocessing
+import signal
+from array import array
+from pathlib import Path
+from queue import Empty
+from threading import Thread
+from time import perf_counter, perf_counter_ns
+
+from commons import Constants, BaseClass
+from logger import log_writer
+from matching import channel_shard, TransferMatcher, new_stats, record_transfers, log_transfers
+
+
+def split_batch(message, n_shards: int) -> dict:
+    """
+    :param message: "sends" or "receives" batch of a branch. See Bank._report.
+    :param n_shards: number of shards.
+    :return: shard -> batch with the events of the channels of the shard.
+    """
+    if message["subject"] == "sends":
+        branch_id, peers, times = message["sender_id"], "receiver_ids", "send_times"
+        shard_of = {peer_id: channel_shard(branch_id, peer_id, n_shards)
+                    for peer_id in set(message[peers])}
+    else:
+        branch_id, peers, times = message["receiver_id"], "sender_ids", "receive_times"
+        shard_of = {peer_id: channel_shard(peer_id, branch_id, n_shards)
+                    for peer_id in set(message[peers])}
+
+    shards = set(shard_of.values())
+    if len(shards) == 1:
+        return {shards.pop(): message}
+
+    rows = {}
+    for i, peer_id in enumerate(message[peers]):
+        rows.setdefault(shard_of[peer_id], []).append(i)
+
+    batches = {}
+    for shard, shard_rows in rows.items():
+        batch = {"subject": message["subject"]}
+        batch["sender_id" if peers == "receiver_ids" else "receiver_id"] = branch_id
+        for column in (peers, "amounts", "seqs", times):
+            values = message[column]
+            batch[column] = array("q", [values[i] for i in shard_rows])
+        batches[shard] = batch
+
+    return batches
+
+
+class MatchWorker(BaseClass):
+    """
+    Matches the events of the channels of one shard, in a worker process.
+    """
+
+    # seconds between two reports to the inspector
+    report_interval = 0.5
+
+    def __init__(self, shard: int, n_shards: int, branch_ids, batches, reports, max_latency_samples: int):
+        """
+        :param shard: the shard of this worker.
+        :param n_shards: number of shards.
+        :param branch_ids: ids of all branches.
+        :param batches: queue of the batches of this shard, and of the "collect" messages
+            (see ShardedMatcher.collect). None stops the worker.
+        :param reports: queue of the reports of all workers. See _report.
+        :param max_latency_samples: see Inspector.
+        """
+        self.get_config()
+
+        self.shard = shard
+
+        # the budget of the inspector is shared by the workers
+        pending = self.inspctr_confs['pending']
+        max_events = pending['max_events']
+        if max_events is not None:
+            max_events //= n_shards
+        spill_path = None
+        if pending['spill_file'] is not None:
+            spill_file = Path(pending['spill_file'])
+            spill_path = Constants.dir_logs / f"{spill_file.stem}_worker{shard}{spill_file.suffix}"
+
+        self.matcher = TransferMatcher(branch_ids, shard, n_shards, max_events, spill_path)
+        self.batches = batches
+        self.reports = reports
+        self.max_latency_samples = max_latency_samples
+
+        # statistics of the run, when the inspector writes them. See Inspector._dump_stats.
+        self.stats = new_stats() if self.inspctr_confs['stats_file'] is not None else None
+        # since the last report
+        self.n_matched = 0
+        self.match_seconds = []
+
+        log_file = Path(self.inspctr_confs['log_file'])
+        self.log_database = Constants.dir_logs / f"{log_file.stem}_worker{shard}{log_file.suffix}"
+        self._log(f"INSPECTOR WORKER {shard} LOG\n", in_file=True, stdio=False, file_mode="w")
+
+    def run(self):
+
+        next_report = perf_counter() + self.report_interval
+        while True:
+            try:
+                message = self.batches.get(timeout=self.report_interval)
+            except Empty:
+                # the inspector was killed before it could stop the worker
+                if not multiprocessing.parent_process().is_alive():
+                    self.reports.cancel_join_thread()
+                    break
+            else:
+                if message is None:
+                    break
+                if message["subject"] == "collect":
+                    self.matcher.collect(message["cut"], message["horizon"])
+                else:
+                    self._match(message)
+
+            if perf_counter() >= next_report:
+                self._report(final=False)
+                next_report = perf_counter() + self.report_interval
+
+        log_writer.flush()
+        self._report(final=True)
+
+    def _match(self, message):
+
+        start = perf_counter_ns()
+        matched = self.matcher.match(message)
+        lookup_ns = perf_counter_ns() - start
+
+        self.n_matched += len(matched)
+        self.match_seconds.append(lookup_ns / 1e9)
+        if self.stats is not None:
+            record_transfers(self.stats, message, matched, lookup_ns, self.max_latency_samples)
+
+        log_transfers(self, matched)
+
+    def _report(self, final: bool):
+        """
+        Sends the statistics of the worker to the inspector: the number of matched transfers and
+        the durations of the matches since the previous report, the number of pending and spilled
+        events and the statistics of the run (see matching.new_stats), if they are collected.
+        """
+        self.reports.put({
+            "shard": self.shard,
+            "final": final,
+            "matched": self.n_matched,
+            "match_seconds": self.match_seconds,
+            "pending": self.matcher.count_pending(),
+            "n_expired": self.matcher.n_expired,
+            "n_spilled": self.matcher.n_spilled,
+            # pickled later, by the thread of the queue
+            "stats": None if self.stats is None else dict(self.stats, latencies=list(self.stats["latencies"]))
+        })
+
+        self.n_matched, self.match_seconds = 0, []
+
+
+def _run_worker(config_file, *args):
+    """
+    Entry point of a worker process.
+    """
+    # the inspector stops the workers, Ctrl-C in its terminal must not
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    Constants.config_file = config_file
+    MatchWorker(*args).run()
+
+
+class ShardedMatcher:
+    """
+    Sends the events to the workers which match them and collects their reports.
+    """
+
+    def __init__(self, n_workers: int, branch_ids, on_report, max_latency_samples: int):
+        """
+        :param n_workers: number of worker processes, one per shard.
+        :param branch_ids: ids of all branches.
+        :param on_report: called with every report of a worker, on the thread of the reports.
+            See MatchWorker._report.
+        :param max_latency_samples: see Inspector.
+        """
+        self.n_workers = n_workers
+        self.on_report = on_report
+        # shard -> its last report
+        self.last_reports = {}
+
+        # the inspector has threads already, which must not be forked
+        context = multiprocessing.get_context("spawn")
+        self.batches = [context.Queue() for _ in range(n_workers)]
+        self.reports = context.Queue()
+        self.workers = [
+            context.Process(target=_run_worker, name=f"inspector_worker{shard}", daemon=True,
+                            args=(Constants.config_file, shard, n_workers, list(branch_ids),
+                                  self.batches[shard], self.reports, max_latency_samples))
+            for shard in range(n_workers)
+        ]
+        self.collector = Thread(target=self._collect_reports, name="shard_reports_th", daemon=True)
+
+    def start(self):
+
+        for worker in self.workers:
+            worker.start()
+        self.collector.start()
+
+    def route(self, message):
+        """
+        Sends the events of a batch to the workers of their channels.
+        :param message: "sends" or "receives" batch of a branch.
+        :return: None
+        """
+        for shard, batch in split_batch(message, self.n_workers).items():
+            self.batches[shard].put(batch)
+
+    def collect(self, cut: int, horizon: int):
+        """
+        Asks the workers to spill the unmatched events before `cut`. See TransferMatcher.collect.
+        They are queued after the batches which have been routed so far.
+        :return: None
+        """
+        for batches in self.batches:
+            batches.put({"subject": "collect", "cut": cut, "horizon": horizon})
+
+    def _collect_reports(self):
+
+        n_final = 0
+        while n_final < self.n_workers:
+            report = self.reports.get()
+            self.last_reports[report["shard"]] = report
+            n_final += report["final"]
+
+            self.on_report(report)
+
+    def count_pending(self) -> int:
+        return self.total("pending")
+
+    def total(self, name: str) -> int:
+        """
+        :param name: a count of the reports, e.g. "n_spilled".
+        :return: its sum over the last reports of the workers.
+        """
+        return sum(report[name] for report in list(self.last_reports.values()))
+
+    def stats(self) -> list:
+        """
+        :return: the last statistics of every worker. See matching.new_stats.
+        """
+        return [report["stats"] for report in list(self.last_reports.values())
+                if report["stats"] is not None]
+
+    def stop(self, timeout: float = 5):
+        """
+        Stops the workers once they have matched the events which were routed to them.
+        :param timeout: seconds to wait for their last reports.
+        :return: None
+        """
+        for batches in self.batches:
+            batches.put(None)
+
+        self.collector.join(timeout)
+        for worker in self.workers:
+            worker.join(timeout)
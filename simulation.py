@@ -0,0 +1,347 @@
+"""
+Discrete-event simulation of the branches in a single process.
+
+The branches are Bank objects which run the same message handlers as the real ones
+(transfer, _handle_message, _do_snappy_things, _check_for_marker, _inspect_channel, ...),
+but their channels are in-memory FIFO queues and time is a virtual clock: nothing sleeps,
+the simulation jumps from one event to the next. So thousands of branches can be simulated,
+and the cost and correctness of the snapshots checked, in seconds.
+
+Differences with the real system:
+    - at every time step, a branch transfers money to one random branch with probability p,
+      instead of to every branch with probability p (which is quadratic in the branches).
+    - transfers are not batched (bank.batch.size is always 1).
+    - there is no inspector process: the global snapshots are checked by the simulation,
+      which knows the total amount of money.
+    - the branches do not log.
+
+Example:
+    python simulation.py --branches 100 1000 --duration 20 --snapshot-interval 5
+"""
+import argparse
+import heapq
+import json
+import random
+import sys
+from itertools import count
+from threading import Lock
+from time import perf_counter, time
+
+from bank import Bank
+from commons import BaseClass
+
+
+class Simulation:
+    """
+    Virtual clock and event queue of a simulation.
+    Events are function calls scheduled at a virtual time. Events scheduled at the same
+    time run in the order they were scheduled.
+    """
+
+    def __init__(self, n_branches: int, args):
+        """
+        :param n_branches: number of branches.
+        :param args: parsed command line arguments. See the end of this file.
+        """
+        # the config is parsed once and shared by all branches
+        self.settings = BaseClass()
+        self.settings.get_config(args.config)
+        bank_confs = self.settings.bank_confs
+        # transfers are not batched
+        bank_confs['batch'] = {"size": 1, "delay": 0}
+
+        self.time_step = bank_confs['time_step'] if args.time_step is None else args.time_step
+        self.p = bank_confs['transaction']['p'] if args.p is None else args.p
+        if args.delay is None:
+            delay = self.settings.brnch_confs[0]['delay']
+            self.min_delay, self.max_delay = delay['min'], delay['max']
+        else:
+            self.min_delay, self.max_delay = args.delay
+        self.n_delays = self.max_delay - self.min_delay + 1
+        self.duration = args.duration
+        self.snapshot_interval = args.snapshot_interval
+
+        self.now = 0.0
+        # (time, order, function, args)
+        self.events = []
+        self.order = count()
+
+        self.n_messages = 0
+        self.n_transfers = 0
+        # start time of the snapshots in progress, indexed by their ids: (initiator, seq)
+        self.started = {}
+        self.snapshots = []
+
+        self.branches = [SimulatedBank(self, bid, n_branches) for bid in range(n_branches)]
+        self.expected_total = sum(branch.balance for branch in self.branches)
+
+        for branch in self.branches:
+            branch.connect(self.branches)
+
+    def schedule(self, at: float, function, *args):
+        """
+        Schedules a function call at the virtual time `at`.
+        :return: None
+        """
+        heapq.heappush(self.events, (at, next(self.order), function, args))
+
+    def delay(self) -> float:
+        """
+        :return: a random latency of a channel, in virtual seconds.
+        """
+        # same distribution as random.randint, which is much slower
+        return self.time_step * (self.min_delay + int(random.random() * self.n_delays))
+
+    def run(self) -> dict:
+        """
+        Runs the transfers and the snapshots for `duration` virtual seconds, then delivers
+        the messages which are still in flight, so every snapshot completes.
+        :return: the results of the simulation.
+        """
+        for branch in self.branches:
+            # the branches do not act in lockstep
+            self.schedule(random.uniform(0, self.time_step), self._tick, branch)
+
+        if self.snapshot_interval:
+            self.schedule(self.snapshot_interval, self._take_snapshot, 1)
+
+        start = perf_counter()
+        n_events = 0
+        events = self.events
+
+        while events:
+            self.now, _, function, args = heapq.heappop(events)
+            function(*args)
+            n_events += 1
+
+        wall_time = perf_counter() - start
+
+        latencies = [snapshot["latency"] for snapshot in self.snapshots]
+        total = sum(branch.balance for branch in self.branches)
+
+        return {
+            "branches": len(self.branches),
+            "virtual_time": self.now,
+            "wall_time": wall_time,
+            "events": n_events,
+            "events_per_sec": n_events / wall_time if wall_time else None,
+            "messages": self.n_messages,
+            "transfers": self.n_transfers,
+            "snapshots": len(self.snapshots),
+            "incomplete_snapshots": len(self.started),
+            "inconsistent_snapshots": sum(not snapshot["consistent"] for snapshot in self.snapshots),
+            "snapshot_latency": {
+                "mean": sum(latencies) / len(latencies) if latencies else None,
+                "max": max(latencies, default=None),
+            },
+            # every transfer has been delivered, so no money is in flight
+            "balance_conserved": total == self.expected_total,
+        }
+
+    def _tick(self, branch):
+        """
+        One time step of a branch: a transfer to a random branch with probability p.
+        """
+        if random.random() < self.p:
+            receiver = random.choice(branch.branches)
+            if branch._transfer_random_amount(receiver):
+                self.n_transfers += 1
+
+        if self.now + self.time_step <= self.duration:
+            self.schedule(self.now + self.time_step, self._tick, branch)
+
+    def _take_snapshot(self, slot: int):
+        """
+        Initiates the snapshot of a slot (see Bank._next_snapshot_slot) and schedules the next one.
+        """
+        snpsht_confs = self.settings.snpsht_confs
+        if snpsht_confs['rotate']:
+            initiator = self.branches[slot % len(self.branches)]
+        else:
+            initiator = self.branches[snpsht_confs['initiator']]
+
+        self.started[initiator.take_snapshot()] = self.now
+
+        at = (slot + 1) * self.snapshot_interval
+        if at <= self.duration:
+            self.schedule(at, self._take_snapshot, slot + 1)
+
+    def collect(self, message):
+        """
+        Checks a global snapshot: the recorded balances and in-flight amounts must add up
+        to the money of the system.
+        :param message: global_snapshot message. See Bank._create_global_snapshot.
+        :return: None
+        """
+        snapshot_id = (message["initiator"], message["seq"])
+        total = sum(local["balance"] + sum(local["in_flight"]) for local in message["local_snapshots"])
+
+        self.snapshots.append({
+            "id": snapshot_id,
+            "latency": self.now - self.started.pop(snapshot_id),
+            "consistent": total == self.expected_total,
+        })
+
+
+class SimulatedChannel:
+    """
+    One-way FIFO channel between two simulated branches. It takes the place of the Outbox
+    of a connection: a sent message is handled by the receiver after a random delay,
+    never before the messages sent before it.
+    """
+
+    __slots__ = ("simulation", "receiver", "sender_index", "last")
+
+    def __init__(self, simulation: Simulation, receiver, sender_index: int):
+        """
+        :param simulation: the simulation.
+        :param receiver: the receiving branch.
+        :param sender_index: index of the sending branch in receiver.branches.
+        """
+        self.simulation = simulation
+        self.receiver = receiver
+        self.sender_index = sender_index
+        # delivery time of the previous message
+        self.last = 0.0
+
+    def send(self, message) -> bool:
+
+        simulation = self.simulation
+        simulation.n_messages += 1
+
+        self.last = max(simulation.now + simulation.delay(), self.last)
+        simulation.schedule(self.last, self.receiver._handle_message, self.sender_index, message)
+
+        return True
+
+
+class SimulatedInspector:
+    """
+    Takes the place of the connection to the inspector. Only the global snapshots are kept.
+    """
+
+    def __init__(self, simulation: Simulation):
+        self.simulation = simulation
+
+    def send(self, message) -> bool:
+
+        if message["subject"] == "global_snapshot":
+            self.simulation.collect(message)
+
+        return True
+
+
+class NoEvents:
+    """
+    Takes the place of the send and receive events (see events.EventBuffer),
+    which are not reported in a simulation.
+    """
+
+    def add(self, *values):
+        return None
+
+    def take(self):
+        return None
+
+
+class SimulatedBank(Bank):
+    """
+    A branch of a simulation. It does not register, listen or connect to anything.
+    """
+
+    def __init__(self, simulation: Simulation, bid: int, n_branches: int):
+        """
+        :param simulation: the simulation.
+        :param bid: id of the branch.
+        :param n_branches: number of branches of the simulation.
+        """
+        self.__dict__.update(vars(simulation.settings))
+
+        self.simulation = simulation
+        self.id = bid
+        self.n_branches = n_branches
+        self.lock = Lock()
+        self.balance = self.bank_confs['initial_balance']
+        if self.balance is None:
+            self.balance = 1_000_000
+
+        self.sent_events = self.received_events = NoEvents()
+        self._init_metrics()
+        self.inspector = {"conn": SimulatedInspector(simulation)}
+
+        self.snapshots = {}
+        self.snapshot_seq = 0
+        self.branches = []
+
+    def connect(self, banks: list):
+        """
+        Opens a channel to every other branch.
+        :param banks: all branches of the simulation, ordered by id.
+        :return: None
+        """
+        for bank in banks:
+            if bank.id != self.id:
+                self.branches.append({
+                    "id": bank.id,
+                    "out_conn": SimulatedChannel(self.simulation, bank, bank._id_to_index(self.id)),
+                    "send_seq": 0,
+                    "batch": [],
+                })
+
+    def _id_to_index(self, bid: int) -> int:
+        # the other branches are ordered by id
+        return bid if bid < self.id else bid - 1
+
+    def _log(self, *args, **kwargs):
+        pass
+
+    def run(self):
+        raise NotImplementedError("Simulated branches are run by their Simulation.")
+
+
+if __name__ == '__main__':
+
+    ap = argparse.ArgumentParser(description="Simulates the branches in a single process, "
+                                             "on a virtual clock.")
+
+    ap.add_argument("-n", "--branches", type=int, nargs="+", default=[100],
+                    help="Numbers of branches. One simulation is run for each of them.")
+    ap.add_argument("--duration", type=float, default=20,
+                    help="Virtual seconds of transfers and snapshots.")
+    ap.add_argument("--time-step", type=float, default=None,
+                    help="Virtual seconds between two transfers of a branch. "
+                         "Default: bank.time_step of the config.")
+    ap.add_argument("-p", type=float, default=None,
+                    help="Probability of a transfer at every time step. "
+                         "Default: bank.transaction.p of the config.")
+    ap.add_argument("--delay", type=int, nargs=2, default=None, metavar=("MIN", "MAX"),
+                    help="Delay of the channels in time steps. Default: delay of the first branch.")
+    ap.add_argument("--snapshot-interval", type=float, default=5,
+                    help="Virtual seconds between two snapshots. 0 disables them.")
+    ap.add_argument("--seed", type=int, default=None)
+    ap.add_argument("--config", default=None, help="Config file. Default: config.yml")
+    ap.add_argument("-o", "--output", default=None,
+                    help="File of the JSON results. They are printed when it is not given.")
+
+    args = ap.parse_args()
+
+    if min(args.branches) < 2:
+        ap.error("At least 2 branches are needed.")
+
+    random.seed(args.seed)
+
+    results = {
+        "time": time(),
+        "python": sys.version.split()[0],
+        "args": vars(args),
+        "runs": [Simulation(n, args).run() for n in args.branches]
+    }
+
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if any(run["inconsistent_snapshots"] or not run["balance_conserved"] for run in results["runs"]):
+        sys.exit(1)
@@ -0,0 +1,194 @@
+"""
+Append-only binary store of the global snapshots.
+
+A store is made of two files, which start with a magic number:
+    <name>.dat: one record per snapshot. A record is made of 8 byte little-endian integers:
+        the number of branches N, the number of non-empty channels M, the ids and the balances
+        of the branches (N each), then the senders, receivers and amounts of the non-empty
+        channels (M each). Senders and receivers are positions in the ids.
+    <name>.idx: one fixed-width entry per snapshot (see INDEX_DTYPE), in the order they were
+        stored, with the offset of its record and what is needed to find it without reading
+        the records: times, initiator, seq, total and in-flight money.
+Entries are written after their records, so the index never refers to a missing record.
+Both files can be memory-mapped by the readers while the inspector appends to them.
+"""
+import numpy as np
+
+from global_state import GlobalState
+
+
+DATA_MAGIC = b"SNAPDAT1"
+INDEX_MAGIC = b"SNAPIDX1"
+
+INDEX_DTYPE = np.dtype([
+    ("offset", "<i8"),  # of the record in the data file, in bytes
+    ("size", "<i8"),  # of the record, in bytes
+    ("time", "<i8"),  # when the snapshot was stored, in ns since the epoch
+    ("request_time", "<i8"),  # when the snapshot was initiated, in ns since the epoch
+    ("preparation_time", "<i8"),  # when the last local snapshot was collected
+    ("initiator", "<i8"),
+    ("seq", "<i8"),
+    ("total", "<i8"),
+    ("in_flight", "<i8"),
+])
+
+_INT = np.dtype("<i8")
+
+
+def _paths(directory, name: str):
+    return directory / f"{name}.dat", directory / f"{name}.idx"
+
+
+class SnapshotStore:
+    """
+    Writes the global snapshots. It is used by a single thread at a time.
+    """
+
+    def __init__(self, directory, name: str = "snapshots"):
+        """
+        Creates an empty store. A previous store with the same name is overwritten.
+        :param directory: directory of the files.
+        :param name: name of the files, without extension.
+        """
+        data_path, index_path = _paths(directory, name)
+
+        self.data = open(data_path, "wb")
+        self.index = open(index_path, "wb")
+        self.data.write(DATA_MAGIC)
+        self.index.write(INDEX_MAGIC)
+
+        self.offset = len(DATA_MAGIC)
+        self.n_snapshots = 0
+
+    def append(self, state: GlobalState, initiator: int, seq: int,
+               request_time: int, preparation_time: int, time: int) -> int:
+        """
+        Stores a global snapshot.
+        :param state: the recorded state.
+        :param initiator: id of the initiator.
+        :param seq: seq of the snapshot.
+        :param request_time: ns since the epoch.
+        :param preparation_time: ns since the epoch.
+        :param time: ns since the epoch.
+        :return: number of the snapshot in the store, starting from 1.
+        """
+        senders, receivers = np.nonzero(state.channels)
+        amounts = state.channels[senders, receivers]
+
+        record = np.concatenate((
+            [len(state.ids), len(amounts)], state.ids, state.balances, senders, receivers, amounts
+        )).astype(_INT).tobytes()
+
+        entry = np.array([(self.offset, len(record), time, request_time, preparation_time,
+                           initiator, seq, state.total, state.in_flight)], dtype=INDEX_DTYPE)
+
+        self.data.write(record)
+        self.data.flush()
+        self.index.write(entry.tobytes())
+        self.index.flush()
+
+        self.offset += len(record)
+        self.n_snapshots += 1
+
+        return self.n_snapshots
+
+    def close(self):
+
+        self.data.close()
+        self.index.close()
+
+
+class SnapshotReader:
+    """
+    Random access to the snapshots of a store, by number or by time.
+    The files are memory-mapped, so only the pages which are used are read.
+    Snapshots stored after the reader was opened are seen after refresh().
+
+    Example:
+        reader = SnapshotReader(Path("logs"))
+        snapshot = reader.get(len(reader))
+        first = reader.find(time() - 60)
+        totals = reader.index["total"]
+    """
+
+    def __init__(self, directory, name: str = "snapshots"):
+        """
+        :param directory: directory of the files.
+        :param name: name of the files, without extension.
+        """
+        self.data_path, self.index_path = _paths(directory, name)
+
+        for path, magic in ((self.data_path, DATA_MAGIC), (self.index_path, INDEX_MAGIC)):
+            with open(path, "rb") as file:
+                if file.read(len(magic)) != magic:
+                    raise ValueError(f"{path} is not a snapshot store.")
+
+        self.index = None
+        self.data = None
+        self.refresh()
+
+    def refresh(self):
+        """
+        Maps the snapshots which have been stored since the last refresh.
+        :return: None
+        """
+        size = self.index_path.stat().st_size - len(INDEX_MAGIC)
+        # an entry may be partially written
+        n_snapshots = size // INDEX_DTYPE.itemsize
+
+        if n_snapshots == 0:
+            self.index = np.empty(0, dtype=INDEX_DTYPE)
+            return
+
+        self.index = np.memmap(self.index_path, dtype=INDEX_DTYPE, mode="r",
+                               offset=len(INDEX_MAGIC), shape=(n_snapshots, ))
+
+        last = self.index[-1]
+        self.data = np.memmap(self.data_path, dtype=np.uint8, mode="r",
+                              shape=(int(last["offset"] + last["size"]), ))
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, number: int) -> dict:
+        """
+        :param number: number of the snapshot, starting from 1
+            (the same as "Global Snapshot #number" in the log of the inspector).
+        :return: dictionary with the fields of its index entry (see INDEX_DTYPE),
+            its number and its state (GlobalState).
+        """
+        if not 1 <= number <= len(self.index):
+            raise IndexError(f"There is no snapshot #{number} in the store.")
+
+        entry = self.index[number - 1]
+        record = self.data[entry["offset"]:entry["offset"] + entry["size"]].view(_INT)
+
+        n_branches, n_channels = int(record[0]), int(record[1])
+        ids, balances, senders, receivers, amounts = np.split(
+            np.array(record[2:]),
+            np.cumsum([n_branches, n_branches, n_channels, n_channels]))
+
+        channels = np.zeros((n_branches, n_branches), dtype=_INT)
+        channels[senders, receivers] = amounts
+
+        snapshot = {name: int(entry[name]) for name in INDEX_DTYPE.names}
+        snapshot["number"] = number
+        snapshot["state"] = GlobalState.from_arrays(ids, balances, channels)
+
+        return snapshot
+
+    def find(self, time: float) -> int:
+        """
+        :param time: seconds since the epoch.
+        :return: number of the first snapshot stored at or after `time`,
+            or len(self) + 1 if there is none.
+        """
+        return int(np.searchsorted(self.index["time"], int(time * 1e9))) + 1
+
+    def between(self, start: float, end: float) -> range:
+        """
+        :param start: seconds since the epoch.
+        :param end: seconds since the epoch.
+        :return: numbers of the snapshots stored from `start` until before `end`.
+        """
+        return range(self.find(start), self.find(end))
@@ -0,0 +1,107 @@
+import random
+import socket
+import unittest
+from array import array
+from datetime import datetime
+from threading import Thread
+
+from codec import FrameReader, pack_message, RECORDS, HEADER, TAG_PICKLE
+
+
+# one message per record, with the tag it must be packed with
+MESSAGES = [
+    ({"subject": "transfer", "amount": 42, "seq": 7}, 1),
+    ({"subject": "marker", "initiator": 2, "seq": 3}, 2),
+    ({"subject": "snapshot", "id": 1, "balance": 999_000, "initiator": 0, "seq": 5,
+      "sender_ids": array("q", [0, 2]), "in_flight": array("q", [10, 20])}, 3),
+    ({"subject": "hello", "id": 4}, 6),
+    ({"subject": "transfers", "seq": 11, "amounts": [1, 2, 3]}, 7),
+    ({"subject": "sends", "sender_id": 1, "receiver_ids": array("q", [0, 2]),
+      "amounts": array("q", [5, 6]), "seqs": array("q", [0, 0]),
+      "send_times": array("q", [1_700_000_000_000_000_000, 1_700_000_000_000_000_001])}, 8),
+    ({"subject": "receives", "receiver_id": 0, "sender_ids": array("q", [1]),
+      "amounts": array("q", [-5]), "seqs": array("q", [2 ** 63 - 1]),
+      "receive_times": array("q", [-2 ** 63])}, 9),
+    # empty columns
+    ({"subject": "snapshot", "id": 1, "balance": 0, "initiator": 1, "seq": 0,
+      "sender_ids": array("q"), "in_flight": array("q")}, 3),
+    # much larger than the buffer of the reader
+    ({"subject": "sends", "sender_id": 3, "receiver_ids": array("q", range(200_000)),
+      "amounts": array("q", range(200_000)), "seqs": array("q", range(200_000)),
+      "send_times": array("q", range(200_000))}, 8),
+    # pickle fallback: an unknown subject, a key the record does not have, a value out of range
+    ({"subject": "global_snapshot", "initiator": 0, "seq": 1, "local_snapshots": [],
+      "request_time": datetime(2024, 1, 2, 3, 4, 5, 6)}, TAG_PICKLE),
+    ({"subject": "transfer", "amount": 1, "seq": 2, "note": "extra"}, TAG_PICKLE),
+    ({"subject": "hello", "id": 2 ** 40}, TAG_PICKLE),
+    ({"subject": "pickled", "payload": b"x" * 300_000}, TAG_PICKLE),
+]
+
+
+def _normalize(message: dict) -> dict:
+    # columns are unpacked as array("q")
+    return {key: list(value) if isinstance(value, (array, list)) else value
+            for key, value in message.items()}
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_every_record_has_a_message(self):
+
+        tags = {tag for _, tag in MESSAGES}
+        self.assertEqual({record.tag for record in RECORDS} - tags, set())
+
+    def test_messages_are_packed_with_their_record(self):
+
+        for message, tag in MESSAGES:
+            frame = pack_message(message)
+            size, = HEADER.unpack_from(frame)
+            self.assertEqual(size, len(frame) - HEADER.size)
+            self.assertEqual(frame[HEADER.size], tag, message["subject"])
+
+    def test_round_trip_with_random_splits(self):
+        """
+        Frames split at random points and coalesced in the same reads must be read back
+        in order, starting from a buffer which is smaller than a header.
+        """
+        messages = [message for message, _ in MESSAGES] * 3
+        data = b"".join(pack_message(message) for message in messages)
+
+        for seed in range(5):
+            rng = random.Random(seed)
+            cuts = sorted(rng.sample(range(1, len(data)), 200))
+
+            writer_end, reader_end = socket.socketpair()
+            with writer_end, reader_end:
+                writer = Thread(target=self._write, args=(writer_end, data, cuts), daemon=True)
+                writer.start()
+
+                received = list(FrameReader(reader_end, buffer_size=3))
+                writer.join(5)
+
+            self.assertEqual(len(received), len(messages), f"seed {seed}")
+            for sent, read in zip(messages, received):
+                self.assertEqual(_normalize(read), _normalize(sent), f"seed {seed}")
+
+    def test_next_message_keeps_the_following_ones(self):
+
+        writer_end, reader_end = socket.socketpair()
+        with writer_end, reader_end:
+            writer_end.sendall(b"".join(pack_message(message) for message, _ in MESSAGES[:3]))
+            writer_end.shutdown(socket.SHUT_WR)
+
+            reader = FrameReader(reader_end, buffer_size=8)
+            for message, _ in MESSAGES[:3]:
+                self.assertEqual(_normalize(reader.next_message()), _normalize(message))
+            self.assertIsNone(reader.next_message())
+
+    @staticmethod
+    def _write(conn, data: bytes, cuts: list):
+
+        for start, end in zip([0] + cuts, cuts + [len(data)]):
+            conn.sendall(data[start:end])
+        conn.shutdown(socket.SHUT_WR)
+
+
+if __name__ == '__main__':
+    unittest.main()
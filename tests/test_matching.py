@@ -0,0 +1,60 @@
+import unittest
+from array import array
+
+from matching import TransferMatcher
+
+
+def _batch(subject: str, branch_id: int, peer_id: int, seqs: list, times: list) -> dict:
+
+    if subject == "sends":
+        keys = ("sender_id", "receiver_ids", "send_times")
+    else:
+        keys = ("receiver_id", "sender_ids", "receive_times")
+
+    return {
+        "subject": subject,
+        keys[0]: branch_id,
+        keys[1]: array("q", [peer_id] * len(seqs)),
+        "amounts": array("q", [10] * len(seqs)),
+        "seqs": array("q", seqs),
+        keys[2]: array("q", times),
+    }
+
+
+class TestTransferMatcherCollect(unittest.TestCase):
+
+    def setUp(self):
+        self.matcher = TransferMatcher([0, 1])
+
+    def test_unread_other_side_is_not_expired(self):
+        """
+        A send whose receive has not been read yet must survive a collection,
+        however old it is, and still be matched afterwards.
+        """
+        self.matcher.match(_batch("sends", 0, 1, [0], [100]))
+        # the receives of branch 1 have only been read until before the horizon
+        self.matcher.match(_batch("receives", 1, 0, [5], [1_500]))
+
+        self.matcher.collect(cut=1_000, horizon=2_000)
+        self.assertEqual(self.matcher.n_expired, 0)
+
+        matched = self.matcher.match(_batch("receives", 1, 0, [0], [120]))
+        self.assertEqual(len(matched), 1)
+        # the receive of seq 5 is still waiting for its send
+        self.assertEqual(self.matcher.count_pending(), 1)
+
+    def test_read_other_side_is_expired(self):
+
+        self.matcher.match(_batch("sends", 0, 1, [0, 1], [100, 1_500]))
+        # the receives of branch 1 have been read past the horizon, without seq 0
+        self.matcher.match(_batch("receives", 1, 0, [1], [2_500]))
+
+        self.matcher.collect(cut=1_000, horizon=2_000)
+
+        self.assertEqual(self.matcher.n_expired, 1)
+        self.assertEqual(self.matcher.count_pending(), 0)
+        self.assertEqual(self.matcher.n_events, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import socket
+import unittest
+from threading import Thread
+
+from outbox import Outbox
+
+
+def _message(i: int) -> dict:
+    # larger than the socket buffers once a few are queued
+    return {"subject": "test", "i": i, "padding": "x" * 100_000}
+
+
+class TestOutboxBackpressure(unittest.TestCase):
+
+    def setUp(self):
+        self.stalled, self.stalled_peer = socket.socketpair()
+        self.stalled.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        # the writer holds a single frame, the others wait in the queue
+        self.outbox = Outbox(self.stalled, "writer_to_stalled_th", max_queued=4, max_batch=1)
+
+    def tearDown(self):
+        self.stalled_peer.close()
+        self.stalled.close()
+
+    def test_send_does_not_block_on_a_stalled_peer(self):
+        """
+        A peer which does not read must only back up its own queue: sending never blocks,
+        and drain waits for room instead, until the peer reads again.
+        """
+        results = []
+        sender = Thread(target=lambda: results.extend(self.outbox.send(_message(i)) for i in range(50)),
+                        daemon=True)
+        sender.start()
+        sender.join(5)
+        self.assertFalse(sender.is_alive(), "send blocked on a stalled peer")
+        self.assertTrue(all(results))
+
+        self.assertFalse(self.outbox.drain(timeout=0.2))
+
+        # the other connections are not held up
+        other, other_peer = socket.socketpair()
+        with other, other_peer:
+            other_outbox = Outbox(other, "writer_to_other_th", max_queued=4)
+            self.assertTrue(other_outbox.send(_message(0)))
+            self.assertTrue(other_outbox.drain(timeout=5))
+
+        reader = Thread(target=self._read_all, daemon=True)
+        reader.start()
+        self.assertTrue(self.outbox.drain(timeout=5))
+
+    def test_drain_returns_when_the_connection_breaks(self):
+
+        for i in range(50):
+            self.outbox.send(_message(i))
+
+        self.stalled_peer.close()
+
+        self.assertTrue(self.outbox.drain(timeout=5))
+        self.outbox.writer.join(5)
+        self.assertFalse(self.outbox.send(_message(50)))
+
+    def _read_all(self):
+
+        try:
+            while self.stalled_peer.recv(1 << 20):
+                pass
+        except OSError:
+            pass
+
+
+if __name__ == '__main__':
+    unittest.main()
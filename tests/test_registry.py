@@ -0,0 +1,62 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from threading import Timer
+from unittest import mock
+
+import registry
+from registry import Registry
+
+
+def _details(bid: int) -> dict:
+    return {"address": "localhost"}
+
+
+@unittest.skipIf(os.name == 'nt', "waiters poll the file on Windows")
+class TestRegistryWait(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.registry = Registry(Path(self.directory.name), poll_interval=1.0)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_wait_sleeps_between_registrations(self):
+        """
+        Once the writer of a notification has closed the pipe, the waiter must sleep until
+        the next registration instead of spinning on the pipe.
+        """
+        self.registry.register(_details)
+
+        timers = [Timer(0.2, self.registry.register, args=(_details, )),
+                  Timer(1.2, self.registry.register, args=(_details, ))]
+        for timer in timers:
+            timer.start()
+
+        try:
+            with mock.patch.object(registry, "select", side_effect=registry.select) as select:
+                members = self.registry.wait(3)
+        finally:
+            for timer in timers:
+                timer.cancel()
+                timer.join()
+
+        self.assertEqual(len(members), 3)
+        # one wake up per registration, and a few timeouts of poll_interval at most
+        self.assertLess(select.call_count, 10)
+
+    def test_wait_returns_registered_members(self):
+
+        for _ in range(2):
+            self.registry.register(_details)
+
+        members = self.registry.wait(2)
+
+        self.assertEqual([member["id"] for member in members], [0, 1])
+        self.assertEqual(list(self.registry.waiters_dir.glob("*.fifo")), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
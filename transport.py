@@ -0,0 +1,284 @@
+"""
+Transports of the channels between the processes.
+
+An endpoint is a dictionary which tells how to reach a listener:
+    {"transport": "tcp", "unix" or "shm", "address": str, "port": int, "path": str}
+address and port are used by tcp, path (of a socket file) by unix and shm.
+
+tcp works between machines. unix and shm are for processes of the same machine
+(POSIX only): unix skips the TCP/IP stack of the loopback interface and shm copies the data
+through a shared memory ring buffer, using a unix socket only to wake up the other side.
+Every connection behaves like a socket: sendall, recv_into, shutdown and close.
+"""
+import asyncio
+import os
+import socket
+import struct
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from select import select
+
+TRANSPORTS = ("tcp", "unix", "shm")
+
+
+def make_endpoint(conf: dict, path, address: str = 'localhost') -> dict:
+    """
+    :param conf: section of the config of a listener, with its transport, address and port.
+    :param path: socket file of the listener for unix and shm.
+    :param address: used when the address of the config is null.
+    :return: the endpoint
+    """
+    return {
+        "transport": conf['transport'],
+        "address": conf['address'] or address,
+        "port": conf['port'],
+        "path": str(path)
+    }
+
+
+def listen(endpoint: dict, backlog: int):
+    """
+    Opens a listener.
+    :param endpoint: where to listen. Port 0 of tcp picks a free port.
+    :param backlog: see socket.listen
+    :return: the listener, which has an accept method like sockets, and its public endpoint.
+    """
+    if endpoint["transport"] == "tcp":
+        listener = socket.create_server((endpoint["address"], endpoint["port"]), backlog=backlog)
+
+        return listener, dict(endpoint, port=listener.getsockname()[1])
+
+    if endpoint["transport"] not in TRANSPORTS:
+        raise ValueError(f"Unknown transport: {endpoint['transport']}")
+
+    # the socket file of a previous run
+    try:
+        os.unlink(endpoint["path"])
+    except FileNotFoundError:
+        pass
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(endpoint["path"])
+    listener.listen(backlog)
+
+    if endpoint["transport"] == "shm":
+        listener = ShmListener(listener)
+
+    return listener, dict(endpoint)
+
+
+def connect(endpoint: dict):
+    """
+    Connects to a listener.
+    :param endpoint: public endpoint of the listener. See listen.
+    :return: the connection.
+    """
+    if endpoint["transport"] == "tcp":
+        return socket.create_connection((endpoint["address"], endpoint["port"]))
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(endpoint["path"])
+    except OSError:
+        sock.close()
+        raise
+
+    if endpoint["transport"] == "shm":
+        return ShmConnection.create(sock)
+
+    return sock
+
+
+async def open_connection(endpoint: dict):
+    """
+    Connects to a listener from an event loop. shm is not supported.
+    :param endpoint: public endpoint of the listener. See listen.
+    :return: asyncio.StreamReader and asyncio.StreamWriter of the connection.
+    """
+    if endpoint["transport"] == "tcp":
+        return await asyncio.open_connection(endpoint["address"], endpoint["port"])
+
+    if endpoint["transport"] == "unix":
+        return await asyncio.open_unix_connection(endpoint["path"])
+
+    raise ValueError(f"The {endpoint['transport']} transport cannot be used by asyncio.")
+
+
+class ShmListener:
+    """
+    Accepts shm connections. See ShmConnection.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def accept(self):
+        conn, address = self.sock.accept()
+        return ShmConnection.attach(conn), address
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+
+    def shutdown(self, how):
+        self.sock.shutdown(how)
+
+    def close(self):
+        self.sock.close()
+
+
+class ShmConnection:
+    """
+    One-way connection through a shared memory ring buffer.
+    The connecting side writes and the accepting side reads. The ring starts with
+    the number of bytes written and read so far, and the flags below. A side which has
+    to wait (empty or full ring) raises its flag and blocks on the unix socket of the
+    connection, and the other side sends a byte through the socket when it sees the flag.
+    The waits are also bounded by `poll_interval`, so a missed wake-up only delays them.
+    """
+
+    # bytes written and read so far, then one byte per flag
+    COUNTER = struct.Struct("Q")
+    WRITTEN, READ = 0, 8
+    READER_WAITING, WRITER_WAITING, CLOSED = 16, 17, 18
+    HEADER_SIZE = 64
+
+    capacity = 1 << 20
+    poll_interval = 0.1
+
+    def __init__(self, sock, shm):
+        self.sock = sock
+        self.shm = shm
+        # only temporary slices of the buffer are made, so the memory can be unmapped anytime
+        self.buf = shm.buf
+        self.size = len(self.buf) - self.HEADER_SIZE
+
+        self.written = self._counter(self.WRITTEN)
+        self.read = self._counter(self.READ)
+        self.eof = False
+
+    def _counter(self, offset: int) -> int:
+        return self.COUNTER.unpack_from(self.buf, offset)[0]
+
+    @classmethod
+    def create(cls, sock):
+        """
+        Creates the ring of a new connection and sends its name to the accepting side.
+        :param sock: connected unix socket.
+        :return: the writing side of the connection.
+        """
+        shm = SharedMemory(create=True, size=cls.HEADER_SIZE + cls.capacity)
+        shm.buf[:cls.HEADER_SIZE] = bytes(cls.HEADER_SIZE)
+
+        name = shm.name.encode()
+        sock.sendall(bytes((len(name), )) + name)
+
+        # the name is removed once the other side has mapped the ring
+        if not sock.recv(1):
+            shm.close()
+            shm.unlink()
+            raise ConnectionResetError("The listener closed the connection.")
+        shm.unlink()
+
+        return cls(sock, shm)
+
+    @classmethod
+    def attach(cls, sock):
+        """
+        Maps the ring of an accepted connection.
+        :param sock: accepted unix socket.
+        :return: the reading side of the connection.
+        """
+        size = sock.recv(1)[0]
+        name = b""
+        while len(name) < size:
+            name += sock.recv(size - len(name))
+
+        shm = SharedMemory(name=name.decode())
+        # the creating side removes it. See create.
+        resource_tracker.unregister(shm._name, "shared_memory")
+        sock.sendall(b"\0")
+
+        return cls(sock, shm)
+
+    def sendall(self, data):
+
+        data = memoryview(data).cast("B")
+        size = self.size
+        ring = self.HEADER_SIZE
+
+        while data:
+            free = size - (self.written - self._counter(self.READ))
+            if free == 0:
+                self._wait(self.WRITER_WAITING,
+                           lambda: self.written - self._counter(self.READ) < size)
+                continue
+
+            n_bytes = min(free, len(data))
+            start = self.written % size
+            first = min(n_bytes, size - start)
+
+            self.buf[ring + start:ring + start + first] = data[:first]
+            self.buf[ring:ring + n_bytes - first] = data[first:n_bytes]
+
+            self.written += n_bytes
+            self.COUNTER.pack_into(self.buf, self.WRITTEN, self.written)
+            data = data[n_bytes:]
+
+            self._wake_up(self.READER_WAITING)
+
+    def recv_into(self, buffer) -> int:
+
+        while self._counter(self.WRITTEN) == self.read:
+            if self.eof or self.buf[self.CLOSED]:
+                return 0
+
+            self._wait(self.READER_WAITING, lambda: self._counter(self.WRITTEN) != self.read)
+
+        size = self.size
+        ring = self.HEADER_SIZE
+        n_bytes = min(self._counter(self.WRITTEN) - self.read, len(buffer))
+        start = self.read % size
+        first = min(n_bytes, size - start)
+
+        buffer[:first] = self.buf[ring + start:ring + start + first]
+        buffer[first:n_bytes] = self.buf[ring:ring + n_bytes - first]
+
+        self.read += n_bytes
+        self.COUNTER.pack_into(self.buf, self.READ, self.read)
+
+        self._wake_up(self.WRITER_WAITING)
+
+        return n_bytes
+
+    def _wait(self, flag: int, ready):
+        """
+        Blocks until `ready()` is True, the other side sends a byte, or `poll_interval` passes.
+        """
+        self.buf[flag] = 1
+        if not ready():
+            readable, _, _ = select([self.sock], [], [], self.poll_interval)
+
+            if readable and not self.sock.recv(4096):
+                self.eof = True
+                if flag == self.WRITER_WAITING:
+                    raise BrokenPipeError("The reader closed the connection.")
+        self.buf[flag] = 0
+
+    def _wake_up(self, flag: int):
+
+        if self.buf[flag]:
+            self.buf[flag] = 0
+            try:
+                self.sock.send(b"\0")
+            except BlockingIOError:
+                pass
+
+    def shutdown(self, how):
+
+        self.buf[self.CLOSED] = 1
+        self.sock.shutdown(how)
+
+    def close(self):
+
+        self.shm.close()
+        self.sock.close()